@@ -0,0 +1,416 @@
+# =============================================================================
+# EZClock 壓力測試
+# 以假的 Telegram Bot API、Geocoding API 與假日 API 啟動 main.py，模擬 N 位員工同時按下
+# 「🟢 上班打卡」並回傳 GPS，量測從按下按鈕到收到「✅ 打卡成功」的延遲。
+#
+# 用法：
+#   python loadtest.py --users 200 --ramp 5 --geocode-latency 150
+#   python loadtest.py --users 200 --baseline loadtest_results/上一次.json
+# 只需要標準函式庫；main.py 本身的相依套件需已安裝。
+# =============================================================================
+
+import argparse
+import json
+import math
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import request as urlrequest
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qs, urlparse
+
+FAKE_BOT_TOKEN = "123456:LOADTEST"
+GROUP_CHAT_ID = -1000000000001
+BASE_USER_ID = 100000
+GPS_LINK_RE = re.compile(r"/gps/(?:app/[^#\s]+#)?([A-Za-z0-9_\-.]+)")
+CHECKIN_OK_PREFIX = "✅ 打卡成功"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    """最近排名法百分位數；沒有資料時回傳 None。"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 1),
+        "p50": round(percentile(values, 50), 1),
+        "p95": round(percentile(values, 95), 1),
+        "p99": round(percentile(values, 99), 1),
+        "max": round(max(values), 1),
+    }
+
+
+# ==== 假的外部服務 ====
+
+class FakeServices:
+    """在同一個 HTTP 伺服器上提供假的 Bot API (/bot<token>/...)、Geocoding (/geocode/json) 與假日 API (/holiday/<year>)。"""
+
+    def __init__(self, bot_latency, geocode_latency, holiday_latency):
+        self.bot_latency = bot_latency
+        self.geocode_latency = geocode_latency
+        self.holiday_latency = holiday_latency
+        self.lock = threading.Condition()
+        self.updates = []           # 待 getUpdates 取走的更新
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.polling_started = threading.Event()
+        self.on_message = None      # callback(chat_id, text, t)
+        self.api_calls = {}
+        self.server = None
+
+    # ---- 測試端注入 ----
+    def push_text(self, user_id, username, text):
+        with self.lock:
+            self.updates.append({
+                "update_id": self.next_update_id,
+                "message": {
+                    "message_id": self.next_message_id, "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private", "username": username},
+                    "from": {"id": user_id, "is_bot": False, "first_name": username, "username": username},
+                    "text": text,
+                },
+            })
+            self.next_update_id += 1
+            self.next_message_id += 1
+            self.lock.notify_all()
+
+    # ---- Bot API ----
+    def _bot_method(self, method, params):
+        with self.lock:
+            self.api_calls[method] = self.api_calls.get(method, 0) + 1
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if self.bot_latency:
+            time.sleep(self.bot_latency)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "EZClock", "username": "ezclock_loadtest_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method in ("sendMessage", "editMessageText", "forwardMessage", "sendPhoto", "sendDocument"):
+            chat_id = int(params.get("chat_id", 0))
+            text = params.get("text", "")
+            if method == "sendMessage" and self.on_message:
+                self.on_message(chat_id, text, time.monotonic())
+            with self.lock:
+                message_id = self.next_message_id
+                self.next_message_id += 1
+            return {"message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}, "text": text}
+        return True
+
+    def _get_updates(self, params):
+        self.polling_started.set()
+        offset = int(params.get("offset") or 0)
+        timeout = min(float(params.get("timeout") or 0), 10)
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.lock.wait(deadline - time.monotonic())
+            return list(self.updates[:100])
+
+    # ---- Geocoding / 假日 API ----
+    def _geocode(self, query):
+        if self.geocode_latency:
+            time.sleep(self.geocode_latency)
+        latlng = query.get("latlng", ["0,0"])[0]
+        return {"status": "OK", "results": [{"formatted_address": f"測試地址 ({latlng})"}]}
+
+    def _holiday(self, year):
+        if self.holiday_latency:
+            time.sleep(self.holiday_latency)
+        # 全年都不是假日，打卡流程不會被假日檢查影響
+        return [{"date": f"{year}0101", "isHoliday": False}]
+
+    def start(self, port):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, payload, status=200):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _params(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                if raw:
+                    if "json" in (self.headers.get("Content-Type") or ""):
+                        params.update(json.loads(raw))
+                    else:
+                        params.update({k: v[0] for k, v in parse_qs(raw.decode("utf-8")).items()})
+                return url.path, params
+
+            def _handle(self):
+                path, params = self._params()
+                parts = path.strip("/").split("/")
+                if parts[0].startswith("bot") and len(parts) == 2:
+                    self._reply({"ok": True, "result": services._bot_method(parts[1], params)})
+                elif path == "/geocode/json":
+                    self._reply(services._geocode(parse_qs(urlparse(self.path).query)))
+                elif parts[0] == "holiday" and len(parts) == 2:
+                    self._reply(services._holiday(parts[1]))
+                else:
+                    self._reply({"ok": False, "description": "Not Found"}, status=404)
+
+            do_GET = _handle
+            do_POST = _handle
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+
+
+# ==== 模擬員工 ====
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.services = FakeServices(args.bot_latency / 1000, args.geocode_latency / 1000,
+                                     args.holiday_latency / 1000)
+        self.services.on_message = self._on_bot_message
+        self.flask_port = free_port()
+        self.fake_port = free_port()
+        self.lock = threading.Lock()
+        self.pressed_at = {}        # user_id -> 按下按鈕的時間
+        self.link_at = {}           # user_id -> 收到 GPS 連結的時間
+        self.submitted_at = {}      # user_id -> /submit 完成的時間
+        self.done_at = {}           # user_id -> 收到打卡成功訊息的時間
+        self.submit_errors = {}     # HTTP 狀態或例外名稱 -> 次數
+        self.submitter = ThreadPoolExecutor(max_workers=args.concurrency)
+        self.all_done = threading.Event()
+
+    def _on_bot_message(self, chat_id, text, t):
+        if chat_id < BASE_USER_ID or chat_id >= BASE_USER_ID + self.args.users:
+            return
+        with self.lock:
+            if chat_id not in self.link_at:
+                match = GPS_LINK_RE.search(text)
+                if match:
+                    self.link_at[chat_id] = t
+                    self.submitter.submit(self._submit_gps, chat_id, match.group(1))
+                    return
+            if text.startswith(CHECKIN_OK_PREFIX) and chat_id not in self.done_at:
+                self.done_at[chat_id] = t
+                if len(self.done_at) == self.args.users:
+                    self.all_done.set()
+
+    def _submit_gps(self, user_id, session_id):
+        if self.args.think_time:
+            time.sleep(self.args.think_time / 1000)
+        i = user_id - BASE_USER_ID
+        body = json.dumps({"session_id": session_id, "lat": 25.033 + i * 1e-5, "lon": 121.565}).encode("utf-8")
+        req = urlrequest.Request(f"http://127.0.0.1:{self.flask_port}/submit", data=body,
+                                 headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            with urlrequest.urlopen(req, timeout=30) as res:
+                res.read()
+            with self.lock:
+                self.submitted_at[user_id] = time.monotonic()
+        except HTTPError as e:
+            self._count_error(f"http_{e.code}")
+        except (URLError, OSError) as e:
+            self._count_error(type(e).__name__)
+
+    def _count_error(self, key):
+        with self.lock:
+            self.submit_errors[key] = self.submit_errors.get(key, 0) + 1
+
+    def _prepare_workdir(self, workdir):
+        with open(os.path.join(workdir, "users.csv"), "w", encoding="utf-8", newline="") as f:
+            f.write("username,name,lat,lon,address,role,user_id,team\n")
+            for i in range(self.args.users):
+                f.write(f"emp{i:05d},員工{i},25.033,121.565,測試辦公室,employee,{BASE_USER_ID + i},\n")
+        env = dict(os.environ)
+        env.update({
+            "BOT_TOKEN": FAKE_BOT_TOKEN,
+            "MAPS_API_KEY": "loadtest",
+            "WEBHOOK_URL": f"http://127.0.0.1:{self.flask_port}",
+            "GROUP_CHAT_ID": str(GROUP_CHAT_ID),
+            "FLASK_PORT": str(self.flask_port),
+            "BOT_API_BASE_URL": f"http://127.0.0.1:{self.fake_port}/bot",
+            "GEOCODE_API_URL": f"http://127.0.0.1:{self.fake_port}/geocode/json",
+            "HOLIDAY_API_URL": f"http://127.0.0.1:{self.fake_port}/holiday",
+            "UPDATE_MODE": "polling",
+            "PYTHONUNBUFFERED": "1",
+        })
+        env.update(dict(kv.split("=", 1) for kv in self.args.env))
+        return env
+
+    def _wait_ready(self, proc, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"main.py exited early with code {proc.returncode}")
+            if self.services.polling_started.is_set():
+                try:
+                    with socket.create_connection(("127.0.0.1", self.flask_port), timeout=1):
+                        return
+                except OSError:
+                    pass
+            time.sleep(0.2)
+        raise RuntimeError("main.py did not become ready in time")
+
+    def run(self):
+        args = self.args
+        self.services.start(self.fake_port)
+        workdir = tempfile.mkdtemp(prefix="ezclock-loadtest-")
+        env = self._prepare_workdir(workdir)
+        main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+        log_path = os.path.join(workdir, "bot.log")
+        print(f"[LoadTest] Work dir: {workdir}")
+        with open(log_path, "w", encoding="utf-8") as log:
+            proc = subprocess.Popen([sys.executable, main_py], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+            try:
+                self._wait_ready(proc)
+                print(f"[LoadTest] Bot ready, pressing buttons for {args.users} users over {args.ramp}s...")
+                started = time.monotonic()
+                for i in range(args.users):
+                    target = started + (args.ramp * i / args.users if args.users else 0)
+                    delay = target - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    user_id = BASE_USER_ID + i
+                    with self.lock:
+                        self.pressed_at[user_id] = time.monotonic()
+                    self.services.push_text(user_id, f"emp{i:05d}", "🟢 上班打卡")
+                self.all_done.wait(timeout=args.timeout)
+                finished = time.monotonic()
+            finally:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                self.submitter.shutdown(wait=False)
+                self.services.stop()
+        result = self._report(started, finished)
+        if args.keep_workdir:
+            result["workdir"] = workdir
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return result
+
+    def _report(self, started, finished):
+        with self.lock:
+            end_to_end = [(self.done_at[u] - self.pressed_at[u]) * 1000 for u in self.done_at]
+            to_link = [(self.link_at[u] - self.pressed_at[u]) * 1000 for u in self.link_at]
+            submit_to_done = [(self.done_at[u] - self.submitted_at[u]) * 1000
+                              for u in self.done_at if u in self.submitted_at]
+            completed = len(self.done_at)
+            errors = dict(self.submit_errors)
+            links = len(self.link_at)
+            submitted = len(self.submitted_at)
+        users = self.args.users
+        elapsed = finished - started
+        return {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "config": {k: v for k, v in vars(self.args).items() if k not in ("output", "baseline")},
+            "counts": {
+                "users": users, "links": links, "submitted": submitted,
+                "completed": completed, "timeouts": users - completed,
+                "submit_errors": errors,
+            },
+            "error_rate": round((users - completed) / users, 4) if users else 0.0,
+            "elapsed_s": round(elapsed, 2),
+            "throughput_per_s": round(completed / elapsed, 2) if elapsed > 0 else None,
+            "latency_ms": {
+                "press_to_confirm": summarize(end_to_end),
+                "press_to_link": summarize(to_link),
+                "submit_to_confirm": summarize(submit_to_done),
+            },
+            "bot_api_calls": dict(self.services.api_calls),
+        }
+
+
+def compare(result, baseline):
+    """與基準結果比較主要指標，回傳可列印的文字行。"""
+    lines = []
+    for key in ("p50", "p95", "p99"):
+        new = result["latency_ms"]["press_to_confirm"].get(key)
+        old = baseline.get("latency_ms", {}).get("press_to_confirm", {}).get(key)
+        if new is not None and old:
+            lines.append(f"  {key}: {old} -> {new} ms ({(new - old) / old * 100:+.1f}%)")
+    for key in ("throughput_per_s", "error_rate"):
+        lines.append(f"  {key}: {baseline.get(key)} -> {result.get(key)}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EZClock 打卡尖峰壓力測試")
+    parser.add_argument("--users", type=int, default=100, help="模擬的員工人數")
+    parser.add_argument("--ramp", type=float, default=5.0, help="所有人在幾秒內按下按鈕")
+    parser.add_argument("--think-time", type=float, default=200, help="收到連結到回傳 GPS 的時間 (ms)")
+    parser.add_argument("--concurrency", type=int, default=50, help="同時回傳 GPS 的連線數")
+    parser.add_argument("--bot-latency", type=float, default=30, help="假 Bot API 的回應延遲 (ms)")
+    parser.add_argument("--geocode-latency", type=float, default=150, help="假 Geocoding API 的回應延遲 (ms)")
+    parser.add_argument("--holiday-latency", type=float, default=200, help="假假日 API 的回應延遲 (ms)")
+    parser.add_argument("--timeout", type=float, default=120, help="等待全部完成的秒數上限")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="額外傳給 main.py 的環境變數 (例如 STORAGE_ENGINE=sqlite)")
+    parser.add_argument("--output", help="結果 JSON 路徑 (預設 loadtest_results/loadtest-<時間>.json)")
+    parser.add_argument("--baseline", help="用來比較的先前結果 JSON")
+    parser.add_argument("--keep-workdir", action="store_true", help="保留暫存目錄 (含 bot.log 與 CSV)")
+    args = parser.parse_args()
+
+    result = LoadTest(args).run()
+
+    output = args.output or os.path.join("loadtest_results", f"loadtest-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    latency = result["latency_ms"]["press_to_confirm"]
+    print(f"[LoadTest] Completed {result['counts']['completed']}/{args.users} "
+          f"in {result['elapsed_s']}s ({result['throughput_per_s']}/s), error rate {result['error_rate']:.2%}")
+    print(f"[LoadTest] Press -> confirm: p50={latency.get('p50')}ms p95={latency.get('p95')}ms p99={latency.get('p99')}ms")
+    if result["counts"]["submit_errors"]:
+        print(f"[LoadTest] Submit errors: {result['counts']['submit_errors']}")
+    print(f"[LoadTest] Results saved to {output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"[LoadTest] Compared with {args.baseline}:")
+        for line in compare(result, baseline):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,22 +9,54 @@
 # =============================================================================
 
 import threading
-from flask import Flask, request, render_template_string
+import heapq
+import gzip
+import hashlib
+import functools
+import contextlib
+import contextvars
+import cProfile
+import pstats
+import random
+from abc import ABC, abstractmethod
+from flask import Flask, Response, request
 from datetime import datetime, timedelta, time
 import os
 import csv
-import random
-import string
+import sqlite3
+import hmac
+import base64
+import secrets
+import signal
 import requests
-from math import radians, cos, sin, asin, sqrt
+from math import radians, cos, sin, asin, sqrt, floor
 import asyncio
+import io
+import json
+import time as time_mod
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 from dotenv import load_dotenv
 
+try:
+    import brotli   # 選用：有安裝時 GPS 頁面另外提供 br 壓縮版本
+except ImportError:
+    brotli = None
+
+try:
+    import numpy as np  # 地理圍籬距離以向量化一次計算；未安裝時退回純 Python 迴圈
+except ImportError:
+    np = None
+
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters,
     ContextTypes, CallbackQueryHandler
 )
+from telegram.ext._application import _STOP_SIGNAL     # PTB 20.0 的停止訊號；PerUserOrderedApplication 自行取件時需要辨識
 
 # ========== 配置區 ==========
 # FIX: 使用 dotenv 讀取環境變數，避免機敏資訊寫死在程式碼中
@@ -39,13 +71,329 @@ WORK_HOURS = {"start": "09:30", "end": "17:30"}
 USERS_CSV_FILE = "users.csv"
 ATTENDANCE_CSV = "attendance_log.csv"
 LEAVE_CSV = "leave_requests.csv"
+SITES_CSV = "sites.csv"                   # 允許打卡的地點 (分店、客戶現場...)
+LEAVE_EVENTS_CSV = "leave_events.csv"      # 請假狀態變更事件 (append-only)，LEAVE_CSV 為其壓實後的表格視圖
+ATTENDANCE_NOTES_CSV = "attendance_notes.csv"  # 出勤紀錄的事後補註 (例如非同步取得的地址)，讀取時疊加到原紀錄
+GPS_TIMEOUT_SECONDS = 60    # 等待 GPS 回傳的逾時秒數
+GPS_MAX_SESSIONS = 10000    # 同時存在的 GPS session 上限
+GPS_TOKEN_MAC_BYTES = 16    # GPS token 簽章長度 (HMAC-SHA256 截斷)
+
+# 地理圍籬：使用者在 users.csv 的登記座標視為一個預設地點；地點數超過門檻時改用網格索引
+SITE_DEFAULT_RADIUS_M = float(os.getenv("SITE_DEFAULT_RADIUS_M", "200"))
+SITE_GRID_THRESHOLD = 1000
+SITE_GRID_CELL_DEG = 0.05   # 約 5 公里
+
+# 接收更新的方式：polling (預設) 或 webhook (與 GPS 頁面共用同一個 Flask 公開網址)
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling").lower()
+TELEGRAM_WEBHOOK_PATH = "/telegram/webhook"
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+# 外部 API 位址：預設為正式服務，可改指向本地替身 (例如 loadtest.py 的假伺服器)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")    # 例如 http://127.0.0.1:8081/bot (後面會接上 token)
+GEOCODE_API_URL = os.getenv("GEOCODE_API_URL", "https://maps.googleapis.com/maps/api/geocode/json")
+
+# 反向地理編碼快取：座標量化到小數點後 4 位 (約 11 公尺網格)
+GEOCODE_CACHE_FILE = "geocode_cache.json"
+GEOCODE_CACHE_TTL = 30 * 24 * 3600      # 秒
+GEOCODE_CACHE_MAX_ENTRIES = 5000
+GEOCODE_GRID_DECIMALS = 4
+
+# 假日行事曆：整年下載一次並存成緊湊的逐日表；HOLIDAY_SOURCE_FILE 可指定離線 JSON (API 格式)
+HOLIDAY_API_URL = os.getenv("HOLIDAY_API_URL", "https://api.pin-yi.me/taiwan-calendar")
+HOLIDAY_CALENDAR_FILE = "holiday_calendar.json"
+HOLIDAY_SOURCE_FILE = os.getenv("HOLIDAY_SOURCE_FILE")
+
+# 上班前預熱：於 WORK_HOURS["start"] 前幾分鐘載入假日表、釘住地點地址、建立 Bot API 連線並走一次 GPS 頁面
+WARMUP_LEAD_MINUTES = int(os.getenv("WARMUP_LEAD_MINUTES", "15"))
+WARMUP_CONNECTIONS = 4      # 預先建立的 Bot API 連線數
+
+# CSV 背景批次寫入：每批最多等待 CSV_FLUSH_INTERVAL 秒；fsync 策略 always / batch / never
+CSV_FLUSH_INTERVAL = float(os.getenv("CSV_FLUSH_INTERVAL", "0.5"))
+CSV_FSYNC_POLICY = os.getenv("CSV_FSYNC_POLICY", "batch")
+
+ATTENDANCE_INDEX_FILE = "attendance_log.idx.json"   # 日期 -> 位元組位移 的稀疏索引
+STATE_SNAPSHOT_FILE = "state_snapshot.json"         # 快速啟動用的狀態快照
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+ADDRESS_PENDING_TEXT = "查詢中…"   # 打卡確認先送出，地址查到後再編輯訊息
+
+# 對外訊息排程：依 Bot API 限制 (全域約 30 則/秒、單一私聊 1 則/秒、群組 20 則/分)
+SEND_GLOBAL_RATE = 30
+SEND_PRIVATE_CHAT_RATE = 1
+SEND_GROUP_CHAT_RATE = 20 / 60
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "8"))
+SEND_MAX_RETRIES = 5
+MONTH_REPORT_CACHE_SIZE = 16    # /monthstat 分頁報表快取的份數上限
+
+# 儲存引擎：csv (預設) 或 sqlite
+STORAGE_ENGINE = os.getenv("STORAGE_ENGINE", "csv").lower()
+SQLITE_DB_FILE = os.getenv("SQLITE_DB_FILE", "ezclock.db")
+
+# GPS token 簽章金鑰：多個 worker 需一致；未設定時由 BOT_TOKEN 衍生
+GPS_TOKEN_SECRET = os.getenv("GPS_TOKEN_SECRET")
+GPS_TOKEN_KEY = hashlib.sha256(("ezclock-gps-token:" + (GPS_TOKEN_SECRET or BOT_TOKEN or "")).encode("utf-8")).digest()
+
+# 更新分派：不同使用者的更新並行處理 (最多 DISPATCH_CONCURRENCY 個)，同一使用者依序處理；
+# 已從 update_queue 取出但尚未處理完的更新最多 DISPATCH_MAX_PENDING 個，其餘留在 update_queue 中
+DISPATCH_CONCURRENCY = int(os.getenv("DISPATCH_CONCURRENCY", "16"))
+DISPATCH_MAX_PENDING = 256
+
+# 追蹤：抽樣比例 (0~1) 與 ring buffer 保留的 trace 數；/profile 最長擷取秒數
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_BUFFER_SIZE = 500
+PROFILE_MAX_SECONDS = 120
+
+# /metrics 與 GPS 頁面共用對外公開的連接埠：需帶 Authorization: Bearer <METRICS_TOKEN>，未設定時停用
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRICS_REFRESH_SECONDS = 15    # 需要讀取共享狀態的指標，由 event loop 定期更新快取值
+
+# 執行期共享狀態 (GPS session、待審假單、筆記轉發名單)：memory (單一程序) 或 sqlite (多程序共用)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "ezclock_state.db")
+GPS_RESULT_POLL_SECONDS = 0.2   # sqlite 後端：有等待中的 session 時，bot 程序檢查其他程序收到的 GPS 回傳的間隔
+FLASK_PORT = int(os.getenv("FLASK_PORT", "5005"))
 
 # ========== 全域變數 ==========
-users = {}              # 從 users.csv 載入的使用者資料
-gps_sessions = {}       # 暫存 GPS 定位資料 (session_id -> {lat, lon, timestamp, done})
-pending_leave = {}      # 暫存請假申請 (待審核)
-active_session = {}     # 暫存打卡流程中的 session_id info
-forwarding_users = {}   # 用來判斷誰的筆記要轉發
+users = {}              # 從 users.csv 載入的使用者資料 (啟動時換成 UserRegistry)
+# pending_leave (待審假單) 與 forwarding_users (筆記轉發名單) 由「共享狀態」區塊依 STATE_BACKEND 建立
+bot_loop = None         # Bot 所在的 asyncio event loop，供 Flask 執行緒跨執行緒喚醒
+telegram_app = None     # Telegram Application，webhook 模式下由 Flask 把更新放進它的 update_queue
+
+# ========== 監控指標 ==========
+# 以 Prometheus 文字格式由 Flask 的 /metrics 輸出；指標在 event loop、Flask 與 I/O 執行緒間共用，以 lock 保護。
+
+class Metric:
+    """指標基底：依 label 值 (tuple) 分別記錄。"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + "}"
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self._format_labels(k), v) for k, v in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {value:g}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """一般 gauge；也可以給 callback，輸出時才讀取目前值 (例如佇列長度)。"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                return [(self.name, "", self.callback())]
+            except Exception:
+                return []
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]    # 各 bucket 次數、總次數、總和
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, (counts, count, total) in self._values.items():
+                for bound, n in zip(self.buckets, counts):
+                    out.append((f"{self.name}_bucket", self._format_labels(key, [("le", f"{bound:g}")]), n))
+                out.append((f"{self.name}_bucket", self._format_labels(key, [("le", "+Inf")]), count))
+                out.append((f"{self.name}_count", self._format_labels(key), count))
+                out.append((f"{self.name}_sum", self._format_labels(key), total))
+        return out
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        return "\n".join(m.render() for m in self._metrics) + "\n"
+
+
+def timed(histogram, errors=None, **labels):
+    """async 函式裝飾器：把執行時間記到 histogram，發生例外時累加 errors。"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time_mod.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time_mod.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = Histogram("ezclock_handler_seconds", "Handler latency in seconds.", ["handler"])
+HANDLER_ERRORS = Counter("ezclock_handler_errors_total", "Handler invocations that raised.", ["handler"])
+EXTERNAL_SECONDS = Histogram("ezclock_external_request_seconds", "External API call latency in seconds.",
+                             ["service", "method"])
+EXTERNAL_REQUESTS = Counter("ezclock_external_requests_total", "External API calls by outcome.",
+                            ["service", "method", "outcome"])
+CSV_SECONDS = Histogram("ezclock_csv_io_seconds", "CSV read/write duration in seconds.", ["op"])
+CSV_BYTES = Counter("ezclock_csv_io_bytes_total", "Bytes read from or written to CSV files.", ["op"])
+JOB_SECONDS = Histogram("ezclock_job_seconds", "Scheduled job duration in seconds.", ["job"])
+JOB_ERRORS = Counter("ezclock_job_errors_total", "Scheduled job runs that raised.", ["job"])
+GPS_SESSIONS = Gauge("ezclock_gps_sessions", "GPS sessions waiting for a location.", callback=lambda: len(gps_store))
+PENDING_LEAVE = Gauge("ezclock_pending_leave", "Leave requests waiting for review.")     # 由 refresh_metrics_job 更新
+DISPATCH_QUEUE = Gauge("ezclock_dispatch_queue_depth", "Updates received but not yet picked up by the dispatcher.",
+                       callback=lambda: telegram_app.update_queue.qsize() if telegram_app else 0)
+DISPATCH_WAITING = Gauge("ezclock_dispatch_waiting", "Updates waiting for an earlier update of the same user or a free slot.")
+DISPATCH_ACTIVE = Gauge("ezclock_dispatch_active", "Updates currently being handled.")
+DISPATCH_WAIT_SECONDS = Histogram("ezclock_dispatch_wait_seconds", "Time an update waited before its handlers ran.")
+GPS_SESSION_REUSES = Counter("ezclock_gps_session_reuses_total", "Check-in taps that reused an in-flight GPS session.")
+WARMUP_ITEMS = Gauge("ezclock_warmup_items", "Items loaded by the last pre-rush warm-up.", ["kind"])
+WARMUP_LAST_SECONDS = Gauge("ezclock_warmup_last_seconds", "Duration of the last pre-rush warm-up in seconds.")
+
+
+# ========== 追蹤 (trace spans) ==========
+# 依 TRACE_SAMPLE_RATE 抽樣，把一次流程 (打卡、請假、統計) 各階段的耗時記成 span，存在固定大小的 ring buffer。
+# 目前的 trace 放在 contextvar 中，asyncio.create_task 建立的背景 task 會自動沿用同一個 trace。
+
+class Trace:
+    __slots__ = ("trace_id", "name", "started_at", "t0", "spans")
+
+    def __init__(self, name):
+        self.trace_id = secrets.token_hex(6)
+        self.name = name
+        self.started_at = datetime.now().isoformat(timespec="milliseconds")
+        self.t0 = time_mod.perf_counter()
+        self.spans = []     # (span 名稱, 相對起點 ms, 耗時 ms, 是否出錯)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id, "name": self.name, "started_at": self.started_at,
+            "spans": [{"name": n, "start_ms": round(s, 2), "duration_ms": round(d, 2), "error": e}
+                      for n, s, d, e in self.spans],
+        }
+
+
+class Tracer:
+    def __init__(self, sample_rate, buffer_size):
+        self.sample_rate = sample_rate
+        self._buffer = deque(maxlen=buffer_size)
+        self._current = contextvars.ContextVar("ezclock_trace", default=None)
+
+    @contextlib.contextmanager
+    def trace(self, name):
+        """開始一個 trace (依抽樣率決定是否記錄)；沒被抽中時裡面的 span 都是空操作。"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            yield None
+            return
+        trace = Trace(name)
+        token = self._current.set(trace)
+        self._buffer.append(trace)      # 先放進 buffer：背景 task 之後補上的 span 也看得到
+        try:
+            with self.span(name):
+                yield trace
+        finally:
+            self._current.reset(token)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        trace = self._current.get()
+        if trace is None:
+            yield
+            return
+        start = time_mod.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            end = time_mod.perf_counter()
+            trace.spans.append((name, (start - trace.t0) * 1000, (end - start) * 1000, error))
+
+    def traced(self, name):
+        """async 函式裝飾器：整個函式包在一個 trace 裡。"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.trace(name):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def recent(self):
+        return [t.to_dict() for t in list(self._buffer)]
+
+
+tracer = Tracer(TRACE_SAMPLE_RATE, TRACE_BUFFER_SIZE)
+
 
 # ========== 檔案初始化 ==========
 
@@ -56,24 +404,956 @@ def ensure_csv_header(file_path, header):
             writer = csv.writer(f)
             writer.writerow(header)
 
+# site / in_fence 為後來新增的欄位；舊檔案的表頭只有前 8 欄，讀取時一律以此清單為準
+ATTENDANCE_HEADER = ["username", "name", "date", "type", "timestamp", "address", "distance_m", "status", "site", "in_fence"]
+LEAVE_HEADER = [
+    "request_id", "username", "name", "reason", "request_time",
+    "status", "approver", "decision_time", "deny_reason", "attachments"
+]
+LEAVE_EVENTS_HEADER = ["event_time", "request_id", "event", "data"]
+ATTENDANCE_NOTES_HEADER = ["username", "timestamp", "type", "field", "value"]
+
+USERS_HEADER = ["username", "name", "lat", "lon", "address", "role", "user_id", "team"]
+
 def ensure_attendance_csv():
     """如果 attendance_log.csv 不存在，則建立並寫入表頭。"""
-    header = ["username", "name", "date", "type", "timestamp", "address", "distance_m", "status"]
-    ensure_csv_header(ATTENDANCE_CSV, header)
+    ensure_csv_header(ATTENDANCE_CSV, ATTENDANCE_HEADER)
 
 def ensure_leave_csv():
     """如果 leave_requests.csv 不存在，則建立並寫入表頭。"""
-    header = [
-        "request_id", "username", "name", "reason", "request_time",
-        "status", "approver", "decision_time", "deny_reason", "attachments"
+    ensure_csv_header(LEAVE_CSV, LEAVE_HEADER)
+
+
+class BatchedCsvWriter:
+    """背景批次寫入器：handler 只把資料列放進 queue，由單一背景 task 分批寫入。
+
+    檔案保持開啟；所有磁碟 I/O 都在單一執行緒的 executor 中依序執行，
+    因此寫入順序與 append 順序一致，也不會阻塞 event loop。
+    """
+
+    def __init__(self, flush_interval, fsync_policy, headers):
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.headers = headers          # path -> 表頭，開檔時若檔案為空則先寫表頭
+        self._files = {}                # path -> 以 "ab" 開啟的檔案
+        self._observers = {}            # path -> [callback(offset, end, row)]，於寫入執行緒呼叫
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="csv-writer")
+        self._queue = None
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def add_observer(self, path, callback):
+        """註冊寫入回呼：每寫入一列就以 (起始位移, 結束位移, row) 呼叫一次。"""
+        self._observers.setdefault(path, []).append(callback)
+
+    def append(self, path, row):
+        """把一列排入寫入佇列 (非阻塞)；尚未啟動時直接同步寫入。"""
+        if self._queue is None:
+            self._write_batch([(path, row)])
+            return
+        self._queue.put_nowait((path, row))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if self.flush_interval > 0:
+                await asyncio.sleep(self.flush_interval)   # group commit：讓同一時段的列合併成一批
+            await self.flush()
+
+    def _drain(self):
+        batch = []
+        while self._queue is not None and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def flush(self):
+        """把佇列中所有資料寫入磁碟，並等待先前已送出的批次完成。"""
+        await self.call(lambda: None)
+
+    async def call(self, func, *args):
+        """先送出佇列中的資料，再於寫入執行緒中執行 func，確保它看到的是完整檔案且不與寫入交錯。"""
+        batch = self._drain()
+        loop = asyncio.get_running_loop()
+        if batch:
+            loop.run_in_executor(self._io, self._write_batch, batch)
+        return await loop.run_in_executor(self._io, func, *args)
+
+    def submit(self, func, *args):
+        """與 call 相同但不等待結果 (非阻塞，func 需自行處理例外)；尚未啟動時直接同步執行。"""
+        if self._queue is None:
+            func(*args)
+            return
+        batch = self._drain()
+        loop = asyncio.get_running_loop()
+        if batch:
+            loop.run_in_executor(self._io, self._write_batch, batch)
+        loop.run_in_executor(self._io, func, *args)
+
+    def _open(self, path):
+        f = self._files.get(path)
+        if f is None:
+            f = open(path, "ab")
+            if f.tell() == 0 and path in self.headers:
+                f.write(self._encode(self.headers[path]))
+            self._files[path] = f
+        return f
+
+    @staticmethod
+    def _encode(row):
+        buf = io.StringIO()
+        csv.writer(buf).writerow(row)
+        return buf.getvalue().encode("utf-8")
+
+    def _write_batch(self, batch):
+        touched = set()
+        started, written = time_mod.perf_counter(), 0
+        for i, (path, row) in enumerate(batch):
+            try:
+                f = self._open(path)
+                offset = f.tell()
+                data = self._encode(row)
+                f.write(data)
+                written += len(data)
+                touched.add(path)
+                for callback in self._observers.get(path, ()):
+                    callback(offset, f.tell(), row)
+                if self.fsync_policy == "always":
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception as e:
+                print(f"[CSV Error] Failed to write row to {path}: {e} ({len(batch) - i} rows pending)")
+                self._close_file(path)
+        for path in touched:
+            f = self._files.get(path)
+            if f is None:
+                continue
+            try:
+                f.flush()
+                if self.fsync_policy == "batch":
+                    os.fsync(f.fileno())
+            except Exception as e:
+                print(f"[CSV Error] Failed to flush {path}: {e}")
+        CSV_SECONDS.observe(time_mod.perf_counter() - started, op="write")
+        CSV_BYTES.inc(written, op="write")
+
+    def _close_file(self, path):
+        f = self._files.pop(path, None)
+        if f is not None:
+            try:
+                f.close()
+            except Exception:
+                pass
+
+    def _close_all(self):
+        for path in list(self._files):
+            self._close_file(path)
+
+    async def close(self):
+        """停止背景 task，寫完剩餘資料並關閉檔案。"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await self.call(self._close_all)
+        self._io.shutdown(wait=True)
+
+
+csv_writer = BatchedCsvWriter(
+    CSV_FLUSH_INTERVAL, CSV_FSYNC_POLICY,
+    headers={ATTENDANCE_CSV: ATTENDANCE_HEADER, LEAVE_EVENTS_CSV: LEAVE_EVENTS_HEADER,
+             ATTENDANCE_NOTES_CSV: ATTENDANCE_NOTES_HEADER}
+)
+
+
+class AttendanceIndex:
+    """attendance_log.csv 的稀疏索引：每個日期記錄 [第一列起始位移, 最後一列結束位移]。
+
+    打卡紀錄是依時間順序附加的，因此查詢某日/某月只需 seek 到該範圍讀取即可。
+    索引在每次寫入時更新 (由 BatchedCsvWriter 回呼)，啟動時若檔案被截斷或改寫就重建。
+    """
+
+    DATE_COL = ATTENDANCE_HEADER.index("date")
+
+    def __init__(self, csv_path, index_path):
+        self.csv_path = csv_path
+        self.index_path = index_path
+        self.days = {}      # "YYYY-MM-DD" -> [start, end]
+        self.size = 0       # 已索引到的檔案位移
+        self._lock = threading.Lock()
+
+    def record(self, start, end, row):
+        """寫入回呼：登記一列的位移。"""
+        date_str = row[self.DATE_COL]
+        with self._lock:
+            span = self.days.get(date_str)
+            if span is None:
+                self.days[date_str] = [start, end]
+            else:
+                span[0] = min(span[0], start)
+                span[1] = max(span[1], end)
+            self.size = max(self.size, end)
+
+    def _scan(self, start):
+        """從 start 位移開始掃描檔案並補齊索引 (start=0 時略過表頭)。"""
+        with open(self.csv_path, "rb") as f:
+            f.seek(start)
+            offset = start
+            if start == 0:
+                offset += len(f.readline())
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break   # 寫到一半的列，留待下次
+                end = offset + len(line)
+                try:
+                    row = next(csv.reader([line.decode("utf-8")]))
+                    if len(row) > self.DATE_COL:
+                        self.record(offset, end, row)
+                except (UnicodeDecodeError, csv.Error, StopIteration):
+                    pass
+                offset = end
+            self.size = offset
+
+    def _is_consistent(self, file_size):
+        if file_size < self.size:
+            return False
+        if not self.days:
+            return True
+        last_date, (start, _) = max(self.days.items(), key=lambda item: item[1][0])
+        with open(self.csv_path, "rb") as f:
+            f.seek(start)
+            line = f.readline()
+        try:
+            return next(csv.reader([line.decode("utf-8")]))[self.DATE_COL] == last_date
+        except (UnicodeDecodeError, csv.Error, StopIteration, IndexError):
+            return False
+
+    def load(self):
+        """載入索引；過期則重建，檔案有新增內容則只掃描尾端。"""
+        if not os.path.exists(self.csv_path):
+            return
+        try:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.days = {k: list(v) for k, v in data.get("days", {}).items()}
+                self.size = data.get("size", 0)
+            file_size = os.path.getsize(self.csv_path)
+            if not self._is_consistent(file_size):
+                print("[Info] Attendance index is stale, rebuilding...")
+                self.days, self.size = {}, 0
+            if file_size > self.size:
+                self._scan(self.size)
+                self.save()
+        except Exception as e:
+            print(f"[Error] Failed to load attendance index, rebuilding: {e}")
+            self.days, self.size = {}, 0
+            self._scan(0)
+
+    def save(self):
+        with self._lock:
+            data = {"size": self.size, "days": dict(self.days)}
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            print(f"[Error] Failed to save {self.index_path}: {e}")
+
+    def read_rows(self, date_from, date_to):
+        """讀取 date_from ~ date_to (含) 的所有紀錄，只讀取索引範圍內的位元組。"""
+        with self._lock:
+            spans = [span for d, span in self.days.items() if date_from <= d <= date_to]
+        if not spans:
+            return []
+        start = min(span[0] for span in spans)
+        end = max(span[1] for span in spans)
+        started = time_mod.perf_counter()
+        with open(self.csv_path, "rb") as f:
+            f.seek(start)
+            chunk = f.read(end - start).decode("utf-8")
+        CSV_SECONDS.observe(time_mod.perf_counter() - started, op="read")
+        CSV_BYTES.inc(end - start, op="read")
+        rows = []
+        for row in csv.DictReader(io.StringIO(chunk, newline=""), fieldnames=ATTENDANCE_HEADER):
+            if date_from <= row["date"] <= date_to:
+                rows.append(row)
+        return rows
+
+
+attendance_index = AttendanceIndex(ATTENDANCE_CSV, ATTENDANCE_INDEX_FILE)
+csv_writer.add_observer(ATTENDANCE_CSV, attendance_index.record)
+
+
+# ========== 儲存層 ==========
+# 所有持久化都經過 Storage 介面；CSV 為預設引擎，SQLite 引擎提供索引查詢與就地更新。
+
+class UserRecord:
+    """單一使用者的資料與今日打卡狀態。打卡欄位請透過 UserRegistry 修改，以維持索引一致。"""
+    __slots__ = ("username", "name", "lat", "lon", "address", "role", "user_id", "team",
+                 "checkin_full", "checkout_full")
+
+    def __init__(self, username, name="", lat=0.0, lon=0.0, address="未知", role="employee",
+                 user_id=None, team=""):
+        self.username = username
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+        self.address = address
+        self.role = role
+        self.user_id = user_id
+        self.team = team
+        self.checkin_full = None     # FIX: 移除 checkin/checkout，只用 full datetime 物件
+        self.checkout_full = None
+
+    @classmethod
+    def from_row(cls, row, username=None):
+        """把 users 資料列 (CSV、SQLite 或快照) 轉成 UserRecord。"""
+        try:
+            lat = float(row.get("lat") or 0)
+            lon = float(row.get("lon") or 0)
+        except (ValueError, TypeError):
+            lat, lon = 0.0, 0.0
+        raw_id = str(row.get("user_id") or "")
+        return cls(
+            username if username is not None else (row.get("username") or "").strip().lower(),
+            name=row.get("name") or "", lat=lat, lon=lon,
+            address=row.get("address") or "未知",
+            role=(row.get("role") or "employee").strip().lower(),
+            user_id=int(raw_id) if raw_id.isdigit() else None,
+            team=(row.get("team") or "").strip().lower(),
+        )
+
+    def to_row(self):
+        return {
+            "username": self.username, "name": self.name, "lat": self.lat, "lon": self.lon,
+            "address": self.address, "role": self.role, "user_id": self.user_id or "",
+            "team": self.team
+        }
+
+
+class UserRegistry:
+    """使用者登錄表：以 username 為主鍵，並維護 user_id、角色與「已上班未下班」索引。
+
+    排程與權限檢查只查索引，不必每次掃過全部使用者。
+    """
+
+    def __init__(self, records=()):
+        self._by_name = {}
+        self._by_user_id = {}
+        self._by_role = {}
+        self._punched = set()       # 今日有任何打卡狀態的人，日切時只需重設這些
+        self.open_checkins = set()  # 已上班、尚未下班
+        for record in records:
+            self.add(record)
+
+    def __contains__(self, uname):
+        return uname in self._by_name
+
+    def __getitem__(self, uname):
+        return self._by_name[uname]
+
+    def __iter__(self):
+        return iter(self._by_name)
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def get(self, uname, default=None):
+        return self._by_name.get(uname, default)
+
+    def items(self):
+        return self._by_name.items()
+
+    def values(self):
+        return self._by_name.values()
+
+    def add(self, record):
+        old = self._by_name.get(record.username)
+        if old is not None:
+            self._unindex(old)
+        self._by_name[record.username] = record
+        if record.user_id:
+            self._by_user_id[record.user_id] = record
+        self._by_role.setdefault(record.role, set()).add(record.username)
+        self._index_punch(record)
+
+    def _unindex(self, record):
+        if record.user_id and self._by_user_id.get(record.user_id) is record:
+            del self._by_user_id[record.user_id]
+        self._by_role.get(record.role, set()).discard(record.username)
+        self._punched.discard(record.username)
+        self.open_checkins.discard(record.username)
+
+    def _index_punch(self, record):
+        if record.checkin_full or record.checkout_full:
+            self._punched.add(record.username)
+        else:
+            self._punched.discard(record.username)
+        if record.checkin_full and not record.checkout_full:
+            self.open_checkins.add(record.username)
+        else:
+            self.open_checkins.discard(record.username)
+
+    def by_user_id(self, user_id):
+        return self._by_user_id.get(user_id)
+
+    def has_role(self, user_id, role):
+        """權限檢查以 Telegram user id 為準 (username 可被使用者更改或留空)。"""
+        record = self._by_user_id.get(user_id)
+        return record is not None and record.username in self._by_role.get(role, ())
+
+    def set_user_id(self, uname, user_id):
+        record = self._by_name[uname]
+        if record.user_id and self._by_user_id.get(record.user_id) is record:
+            del self._by_user_id[record.user_id]
+        record.user_id = user_id
+        if user_id:
+            self._by_user_id[user_id] = record
+
+    def set_checkin(self, uname, when):
+        record = self._by_name[uname]
+        record.checkin_full = when
+        self._index_punch(record)
+
+    def set_checkout(self, uname, when):
+        record = self._by_name[uname]
+        record.checkout_full = when
+        self._index_punch(record)
+
+    def reset_day(self):
+        """日切：只重設今日有打卡狀態的使用者。"""
+        for uname in self._punched:
+            record = self._by_name[uname]
+            record.checkin_full = None
+            record.checkout_full = None
+        self._punched.clear()
+        self.open_checkins.clear()
+
+    def checked_in_not_out(self):
+        """已上班未下班的使用者 (複本，可在迭代中修改狀態)。"""
+        return [self._by_name[uname] for uname in list(self.open_checkins)]
+
+def read_csv_dicts(path, fieldnames=None):
+    """讀取整份 CSV。指定 fieldnames 時略過檔案本身的表頭 (舊檔案的表頭可能缺少後來新增的欄位)。"""
+    if not os.path.exists(path):
+        return []
+    started = time_mod.perf_counter()
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if fieldnames is not None:
+            next(f, None)
+        rows = list(csv.DictReader(f, fieldnames=fieldnames))
+    CSV_BYTES.inc(os.path.getsize(path), op="read")
+    CSV_SECONDS.observe(time_mod.perf_counter() - started, op="read")
+    return rows
+
+def _attendance_key(row):
+    return (row["username"], row["timestamp"], row["type"])
+
+def load_attendance_notes():
+    """讀取出勤補註檔：(username, timestamp, type) -> {欄位: 值}，後寫的覆蓋先寫的。"""
+    notes = {}
+    for row in read_csv_dicts(ATTENDANCE_NOTES_CSV):
+        notes.setdefault(_attendance_key(row), {})[row["field"]] = row["value"]
+    return notes
+
+def apply_attendance_notes(rows, notes):
+    if notes:
+        for row in rows:
+            fields = notes.get(_attendance_key(row))
+            if fields:
+                row.update(fields)
+    return rows
+
+def write_csv_dicts(path, header, rows):
+    """以暫存檔 + os.replace 原子寫出整份 CSV。"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=header, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: ("" if row.get(k) is None else row.get(k)) for k in header})
+    os.replace(tmp_path, path)
+
+
+class Storage(ABC):
+    """儲存層介面。同步方法可在啟動時直接呼叫；async 方法供 handler 在 event loop 中使用。
+
+    handler 會呼叫的同步寫入方法 (append_* / save_users / add_leave_attachment) 只能排入背景寫入，不可阻塞。
+    """
+
+    attendance_version = 0      # 每新增一筆出勤紀錄就遞增，供報表快取判斷是否過期
+
+    def open(self): ...
+    def start(self): ...
+    async def close(self): ...
+    def close_sync(self): ...
+    async def checkpoint(self): ...
+
+    @abstractmethod
+    def load_users(self): ...
+    @abstractmethod
+    def save_users(self, records): ...
+
+    @abstractmethod
+    def append_attendance(self, row): ...
+    @abstractmethod
+    def read_attendance(self, date_from, date_to, username=None): ...
+    @abstractmethod
+    async def query_attendance(self, date_from, date_to, username=None): ...
+
+    @abstractmethod
+    async def attendance_offset(self):
+        """目前已落盤的出勤紀錄位置 (CSV 為位元組位移，SQLite 為最大 id)。"""
+
+    @abstractmethod
+    def read_attendance_since(self, offset):
+        """讀取 offset 之後的出勤紀錄，回傳 (rows, 新 offset)；offset 無效時回傳 (None, None)。"""
+
+    @abstractmethod
+    async def annotate_attendance(self, row, fields):
+        """事後補上一筆出勤紀錄的欄位 (以 username + timestamp + type 識別；row 也需含 date 以便使用索引)。"""
+
+    def users_signature(self):
+        """使用者資料來源的版本標記；與快照相同時可直接沿用快照中的使用者。None 表示不可沿用。"""
+        return None
+
+    @abstractmethod
+    def append_leave(self, record): ...
+    @abstractmethod
+    async def update_leave(self, request_id, updates): ...
+    @abstractmethod
+    def add_leave_attachment(self, request_id, file_id): ...
+    @abstractmethod
+    def read_leave(self): ...
+
+    @abstractmethod
+    def import_csv(self):
+        """把 CSV 檔案匯入目前的引擎。"""
+
+    @abstractmethod
+    def export_csv(self):
+        """把目前引擎的資料匯出成 CSV 檔案。"""
+
+
+class LeaveLedger:
+    """請假事件帳本：狀態變更以事件 (created/approved/denied/attachment) 附加到 leave_events.csv，
+    目前狀態由事件折疊而得，並以 request_id 建立記憶體索引。"""
+
+    def __init__(self, events_path, view_path):
+        self.events_path = events_path
+        self.view_path = view_path
+        self.records = {}       # request_id -> 折疊後的紀錄 (欄位同 LEAVE_HEADER)
+        self.dirty = False      # 表格視圖是否需要重新壓實
+
+    def apply(self, request_id, event, data):
+        """把一個事件折疊進目前狀態。"""
+        if event == "created":
+            record = {k: "" for k in LEAVE_HEADER}
+            record.update({k: v for k, v in data.items() if k in LEAVE_HEADER})
+            record["request_id"] = request_id
+            self.records[request_id] = record
+        else:
+            record = self.records.get(request_id)
+            if record is None:
+                return
+            if event == "attachment":
+                file_id = data.get("file_id", "")
+                record["attachments"] = ";".join(filter(None, [record.get("attachments", ""), file_id]))
+            else:
+                record.update({k: v for k, v in data.items() if k in LEAVE_HEADER and k != "request_id"})
+        self.dirty = True
+
+    def record_event(self, request_id, event, data):
+        """附加事件 (交給背景寫入器) 並立即更新記憶體狀態。"""
+        csv_writer.append(self.events_path, [
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"), request_id, event,
+            json.dumps(data, ensure_ascii=False)
+        ])
+        self.apply(request_id, event, data)
+
+    def load(self):
+        """重播事件檔重建狀態；首次啟用時把既有的 leave_requests.csv 轉成 created 事件。"""
+        if not os.path.exists(self.events_path) or os.path.getsize(self.events_path) == 0:
+            legacy_rows = read_csv_dicts(self.view_path)
+            for row in legacy_rows:
+                if row.get("request_id"):
+                    self.record_event(row["request_id"], "created", row)
+            if legacy_rows:
+                print(f"[Info] Migrated {len(legacy_rows)} leave requests into {self.events_path}.")
+            return
+        try:
+            for row in read_csv_dicts(self.events_path):
+                try:
+                    data = json.loads(row.get("data") or "{}")
+                except ValueError:
+                    continue
+                self.apply(row["request_id"], row["event"], data)
+            self.dirty = False
+        except Exception as e:
+            print(f"[Error] Failed to replay {self.events_path}: {e}")
+
+    async def compact(self):
+        """把目前狀態寫成表格式的 leave_requests.csv (在寫入執行緒中原子替換)。"""
+        if not self.dirty:
+            return
+        self.dirty = False
+        rows = [dict(r) for r in self.records.values()]
+        try:
+            await csv_writer.call(write_csv_dicts, self.view_path, LEAVE_HEADER, rows)
+        except Exception as e:
+            self.dirty = True
+            print(f"[CSV Error] Failed to compact {self.view_path}: {e}")
+
+
+leave_ledger = LeaveLedger(LEAVE_EVENTS_CSV, LEAVE_CSV)
+
+
+class CsvStorage(Storage):
+    """預設引擎：CSV 檔案 + 背景批次寫入器 + 出勤日期索引。"""
+
+    def __init__(self):
+        self._notes = {}    # 出勤補註，CSV 本身只追加不改寫
+
+    def open(self):
+        ensure_csv_header(USERS_CSV_FILE, USERS_HEADER)
+        ensure_attendance_csv()
+        ensure_leave_csv()
+        attendance_index.load()
+        leave_ledger.load()
+        self._notes = load_attendance_notes()
+
+    def start(self):
+        csv_writer.start()
+
+    async def close(self):
+        await leave_ledger.compact()
+        await csv_writer.close()
+        attendance_index.save()
+
+    def close_sync(self):
+        attendance_index.save()
+
+    async def checkpoint(self):
+        await csv_writer.call(attendance_index.save)
+        await leave_ledger.compact()
+
+    def load_users(self):
+        registry = UserRegistry()
+        try:
+            for row in read_csv_dicts(USERS_CSV_FILE):
+                record = UserRecord.from_row(row)
+                if record.username:
+                    registry.add(record)
+        except Exception as e:
+            print(f"[Error] Failed to load users.csv: {e}")
+        return registry
+
+    def save_users(self, records):
+        # 在 event loop 上先複製資料列，實際寫檔交給寫入執行緒
+        csv_writer.submit(self._save_users, [r.to_row() for r in records])
+
+    @staticmethod
+    def _save_users(rows):
+        try:
+            write_csv_dicts(USERS_CSV_FILE, USERS_HEADER, rows)
+        except Exception as e:
+            print(f"[Error] Failed to save users.csv: {e}")
+
+    def append_attendance(self, row):
+        csv_writer.append(ATTENDANCE_CSV, [row.get(k, "") for k in ATTENDANCE_HEADER])
+        self.attendance_version += 1
+
+    def read_attendance(self, date_from, date_to, username=None):
+        rows = attendance_index.read_rows(date_from, date_to)
+        return apply_attendance_notes([r for r in rows if not username or r["username"] == username], self._notes)
+
+    async def query_attendance(self, date_from, date_to, username=None):
+        # 在寫入執行緒中讀取，保證看得到所有已排入佇列的紀錄
+        return await csv_writer.call(self.read_attendance, date_from, date_to, username)
+
+    async def attendance_offset(self):
+        return await csv_writer.call(lambda: attendance_index.size)
+
+    def read_attendance_since(self, offset):
+        if not os.path.exists(ATTENDANCE_CSV) or os.path.getsize(ATTENDANCE_CSV) < offset:
+            return None, None
+        with open(ATTENDANCE_CSV, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        complete = data[:data.rfind(b"\n") + 1]    # 只讀完整的列
+        rows = list(csv.DictReader(io.StringIO(complete.decode("utf-8"), newline=""), fieldnames=ATTENDANCE_HEADER))
+        return apply_attendance_notes(rows, self._notes), offset + len(complete)
+
+    async def annotate_attendance(self, row, fields):
+        key = _attendance_key(row)
+        for field, value in fields.items():
+            csv_writer.append(ATTENDANCE_NOTES_CSV, [*key, field, value])
+        self._notes.setdefault(key, {}).update(fields)
+        self.attendance_version += 1
+
+    def users_signature(self):
+        try:
+            st = os.stat(USERS_CSV_FILE)
+            return [st.st_mtime, st.st_size]
+        except OSError:
+            return None
+
+    def append_leave(self, record):
+        leave_ledger.record_event(record["request_id"], "created", record)
+
+    async def update_leave(self, request_id, updates):
+        if request_id not in leave_ledger.records:
+            print(f"[CSV Error] Failed to update leave record {request_id}: not found")
+            return False
+        event = updates.get("status") if updates.get("status") in ("approved", "denied") else "updated"
+        leave_ledger.record_event(request_id, event, updates)
+        return True
+
+    def add_leave_attachment(self, request_id, file_id):
+        leave_ledger.record_event(request_id, "attachment", {"file_id": file_id})
+
+    def read_leave(self):
+        return [dict(r) for r in leave_ledger.records.values()]
+
+    def import_csv(self):
+        print("[Info] CSV engine already reads the CSV files; nothing to import.")
+
+    def export_csv(self):
+        print("[Info] CSV engine already stores data as CSV; nothing to export.")
+
+
+class SqliteStorage(Storage):
+    """SQLite 引擎：WAL 模式，(date, username)、status、request_id 皆有索引。
+
+    所有操作在單一執行緒的 executor 中執行 (同一條連線)，async 方法不會阻塞 event loop；
+    handler 呼叫的同步寫入方法只排入該執行緒 (與 CSV 引擎的背景寫入器相同)，不等待完成。
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY, name TEXT, lat REAL, lon REAL,
+            address TEXT, role TEXT, user_id INTEGER, team TEXT)""",
+        """CREATE TABLE IF NOT EXISTS attendance (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, name TEXT, date TEXT,
+            type TEXT, timestamp TEXT, address TEXT, distance_m INTEGER, status TEXT,
+            site TEXT, in_fence INTEGER)""",
+        "CREATE INDEX IF NOT EXISTS idx_attendance_date_username ON attendance(date, username)",
+        """CREATE TABLE IF NOT EXISTS leave_requests (
+            request_id TEXT PRIMARY KEY, username TEXT, name TEXT, reason TEXT,   -- 主鍵即 request_id 索引
+            request_time TEXT, status TEXT, approver TEXT, decision_time TEXT,
+            deny_reason TEXT, attachments TEXT)""",
+        "CREATE INDEX IF NOT EXISTS idx_leave_status ON leave_requests(status)",
     ]
-    ensure_csv_header(LEAVE_CSV, header)
+    # 舊資料庫缺少的欄位：(表格, 欄位, 型別)
+    MIGRATIONS = [("users", "team", "TEXT"), ("attendance", "site", "TEXT"), ("attendance", "in_fence", "INTEGER")]
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._lock = threading.Lock()
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for stmt in self.SCHEMA:
+            self.conn.execute(stmt)
+        for table, column, col_type in self.MIGRATIONS:
+            existing = {r["name"] for r in self.conn.execute(f"PRAGMA table_info({table})")}
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type}")
+        self.conn.commit()
+
+    def _execute(self, sql, params=(), many=False):
+        with self._lock:
+            if many:
+                self.conn.executemany(sql, params)
+            else:
+                self.conn.execute(sql, params)
+            self.conn.commit()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(r) for r in self.conn.execute(sql, params).fetchall()]
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._io, func, *args)
+
+    def _submit(self, func, *args):
+        """排入寫入執行緒、不等待結果；之後經 _run 的查詢會看到這筆寫入 (單一執行緒依序執行)。"""
+        self._io.submit(func, *args).add_done_callback(self._log_write_failure)
+
+    @staticmethod
+    def _log_write_failure(future):
+        if not future.cancelled() and future.exception():
+            print(f"[DB Error] Background write failed: {future.exception()}")
+
+    async def close(self):
+        await self._run(self.close_sync)
+        self._io.shutdown(wait=True)
+
+    def close_sync(self):
+        if self.conn is not None:
+            with self._lock:
+                self.conn.close()
+                self.conn = None
+
+    async def checkpoint(self):
+        await self._run(self._execute, "PRAGMA wal_checkpoint(PASSIVE)")
+
+    def load_users(self):
+        return UserRegistry(UserRecord.from_row(r) for r in self._query("SELECT * FROM users"))
+
+    def _save_users(self, rows):
+        self._execute(
+            f"INSERT OR REPLACE INTO users ({', '.join(USERS_HEADER)}) "
+            f"VALUES ({', '.join(':' + c for c in USERS_HEADER)})",
+            [{**r, "user_id": r["user_id"] or None} for r in rows], many=True
+        )
+
+    def save_users(self, records):
+        self._submit(self._save_users, [r.to_row() for r in records])
+
+    def append_attendance(self, row):
+        cols = ", ".join(ATTENDANCE_HEADER)
+        marks = ", ".join(f":{c}" for c in ATTENDANCE_HEADER)
+        self._submit(self._execute, f"INSERT INTO attendance ({cols}) VALUES ({marks})",
+                     {c: row.get(c, "") for c in ATTENDANCE_HEADER})
+        self.attendance_version += 1
+
+    def read_attendance(self, date_from, date_to, username=None):
+        sql = f"SELECT {', '.join(ATTENDANCE_HEADER)} FROM attendance WHERE date BETWEEN ? AND ?"
+        params = [date_from, date_to]
+        if username:
+            sql += " AND username = ?"
+            params.append(username)
+        rows = self._query(sql + " ORDER BY id", params)
+        for r in rows:
+            for key in ("distance_m", "in_fence", "site"):
+                r[key] = "" if r[key] is None else str(r[key])
+        return rows
+
+    async def query_attendance(self, date_from, date_to, username=None):
+        return await self._run(self.read_attendance, date_from, date_to, username)
+
+    async def attendance_offset(self):
+        rows = await self._run(self._query, "SELECT COALESCE(MAX(id), 0) AS last_id FROM attendance")
+        return rows[0]["last_id"]
+
+    def read_attendance_since(self, offset):
+        rows = self._query(f"SELECT id, {', '.join(ATTENDANCE_HEADER)} FROM attendance WHERE id > ? ORDER BY id", (offset,))
+        new_offset = rows[-1]["id"] if rows else offset
+        return rows, new_offset
+
+    async def annotate_attendance(self, row, fields):
+        fields = {k: v for k, v in fields.items() if k in ATTENDANCE_HEADER}
+        if not fields:
+            return
+        assignments = ", ".join(f"{k} = :{k}" for k in fields)
+        await self._run(self._execute,
+                        f"UPDATE attendance SET {assignments} "
+                        "WHERE date = :_date AND username = :_username AND timestamp = :_timestamp AND type = :_type",
+                        {**fields, "_date": row["date"], "_username": row["username"],
+                         "_timestamp": row["timestamp"], "_type": row["type"]})
+        self.attendance_version += 1
+
+    def _insert_leave(self, record):
+        cols = ", ".join(LEAVE_HEADER)
+        marks = ", ".join(f":{c}" for c in LEAVE_HEADER)
+        self._execute(f"INSERT OR REPLACE INTO leave_requests ({cols}) VALUES ({marks})",
+                      {c: record.get(c, "") for c in LEAVE_HEADER})
+
+    def append_leave(self, record):
+        self._submit(self._insert_leave, dict(record))
+
+    def _update_leave(self, request_id, updates):
+        fields = {k: v for k, v in updates.items() if k in LEAVE_HEADER and k != "request_id"}
+        if not fields:
+            return False
+        assignments = ", ".join(f"{k} = :{k}" for k in fields)
+        self._execute(f"UPDATE leave_requests SET {assignments} WHERE request_id = :request_id",
+                      {**fields, "request_id": request_id})
+        return True
+
+    async def update_leave(self, request_id, updates):
+        try:
+            return await self._run(self._update_leave, request_id, updates)
+        except sqlite3.Error as e:
+            print(f"[DB Error] Failed to update leave record {request_id}: {e}")
+            return False
+
+    def add_leave_attachment(self, request_id, file_id):
+        self._submit(
+            self._execute,
+            "UPDATE leave_requests SET attachments = "
+            "CASE WHEN attachments IS NULL OR attachments = '' THEN ? ELSE attachments || ';' || ? END "
+            "WHERE request_id = ?", (file_id, file_id, request_id)
+        )
+
+    def read_leave(self):
+        return self._query(f"SELECT {', '.join(LEAVE_HEADER)} FROM leave_requests ORDER BY request_time")
+
+    def import_csv(self):
+        users_rows = read_csv_dicts(USERS_CSV_FILE)
+        self._save_users([UserRecord.from_row(r).to_row() for r in users_rows if (r.get("username") or "").strip()])
+        # 出勤紀錄沒有自然鍵，重複匯入會讓每筆紀錄多一份；資料表已有資料時不匯入
+        existing = self._query("SELECT COUNT(*) AS n FROM attendance")[0]["n"]
+        if existing:
+            print(f"[Warning] {self.path} already has {existing} attendance rows; skipping attendance import.")
+            attendance_rows = []
+        else:
+            attendance_rows = apply_attendance_notes(read_csv_dicts(ATTENDANCE_CSV, ATTENDANCE_HEADER),
+                                                     load_attendance_notes())
+            cols = ", ".join(ATTENDANCE_HEADER)
+            marks = ", ".join(f":{c}" for c in ATTENDANCE_HEADER)
+            self._execute(f"INSERT INTO attendance ({cols}) VALUES ({marks})",
+                          [{c: r.get(c) or "" for c in ATTENDANCE_HEADER} for r in attendance_rows], many=True)
+        leave_rows = read_csv_dicts(LEAVE_CSV)
+        for r in leave_rows:
+            self._insert_leave(r)
+        print(f"[Info] Imported {len(users_rows)} users, {len(attendance_rows)} attendance rows, "
+              f"{len(leave_rows)} leave requests into {self.path}.")
+
+    def export_csv(self):
+        users_map = self.load_users()
+        write_csv_dicts(USERS_CSV_FILE, USERS_HEADER, [r.to_row() for r in users_map.values()])
+        attendance_rows = self._query(f"SELECT {', '.join(ATTENDANCE_HEADER)} FROM attendance ORDER BY id")
+        write_csv_dicts(ATTENDANCE_CSV, ATTENDANCE_HEADER, attendance_rows)
+        for path in (ATTENDANCE_INDEX_FILE, ATTENDANCE_NOTES_CSV):
+            if os.path.exists(path):
+                os.remove(path)     # CSV 內容已改寫 (地址已是最終值)，索引需重建、補註不再需要
+        write_csv_dicts(LEAVE_CSV, LEAVE_HEADER, self.read_leave())
+        print(f"[Info] Exported {len(users_map)} users and {len(attendance_rows)} attendance rows to CSV.")
+
+
+def create_storage(engine):
+    if engine == "sqlite":
+        return SqliteStorage(SQLITE_DB_FILE)
+    return CsvStorage()
+
+
+storage = create_storage(STORAGE_ENGINE)
 
 
 # ======== Flask 部分：呈現 GPS 定位頁面 ==========
 flask_app = Flask(__name__)
 
-# FIX: HTML_TEMPLATE 保持不變，是正確的。
+# GPS 頁面是固定不變的靜態外殼，session id 由前端從 URL fragment (#sid) 或路徑讀取，
+# 因此可以在啟動時預先壓縮，並以 ETag / Cache-Control 讓瀏覽器快取。
 
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -259,6 +1539,7 @@ HTML_TEMPLATE = '''
 
     <script>
         let isProcessing = false;
+        const SESSION_ID = decodeURIComponent(location.hash.slice(1)) || location.pathname.split('/').pop();
 
         function getLocation() {
             if (isProcessing) return;
@@ -294,7 +1575,7 @@ HTML_TEMPLATE = '''
                 method: 'POST',
                 headers: {'Content-Type': 'application/json'},
                 body: JSON.stringify({
-                    session_id: '{{ sid }}',
+                    session_id: SESSION_ID,
                     lat: position.coords.latitude,
                     lon: position.coords.longitude
                 })
@@ -379,117 +1660,740 @@ HTML_TEMPLATE = '''
 '''
 
 
+def _build_gps_page_assets(html):
+    """預先產生各種編碼的頁面內容與對應的 ETag。"""
+    raw = html.encode("utf-8")
+    version = hashlib.sha256(raw).hexdigest()[:16]
+    assets = {"identity": raw, "gzip": gzip.compress(raw, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        assets["br"] = brotli.compress(raw, quality=11)
+    return version, assets
+
+
+GPS_PAGE_VERSION, GPS_PAGE_ASSETS = _build_gps_page_assets(HTML_TEMPLATE)
+
+
+def _serve_gps_page(cache_control):
+    accepted = request.headers.get("Accept-Encoding", "")
+    encoding = "identity"
+    if "br" in accepted and "br" in GPS_PAGE_ASSETS:
+        encoding = "br"
+    elif "gzip" in accepted:
+        encoding = "gzip"
+
+    etag = f'"{GPS_PAGE_VERSION}-{encoding}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(GPS_PAGE_ASSETS[encoding], status=200, headers=headers, content_type="text/html; charset=utf-8")
+
+
+def gps_page_url(session_id):
+    """打卡連結：版本化的頁面網址 + fragment 中的 session id (fragment 不會送到伺服器)。"""
+    return f"{WEBHOOK_URL}/gps/app/{GPS_PAGE_VERSION}#{session_id}"
+
+
+@flask_app.route("/gps/app/<version>")
+def gps_page_asset(version):
+    # 版本相符時內容永遠不變，可以長期快取
+    if version == GPS_PAGE_VERSION:
+        return _serve_gps_page("public, max-age=31536000, immutable")
+    return _serve_gps_page("no-cache")
+
 @flask_app.route("/gps/<sid>")
 def gps_page(sid):
-    return render_template_string(HTML_TEMPLATE, sid=sid)
+    # 舊格式連結：同一份外殼，session id 由前端從路徑取得；先以簽章擋掉偽造與過期的連結
+    status, _ = verify_gps_token(sid)
+    if status == "invalid":
+        return "Unknown session", 404
+    if status == "expired":
+        return "Session expired", 410
+    return _serve_gps_page("no-cache")
+
+# ==== 共享狀態 ====
+# GPS session、待審假單與筆記轉發名單透過 StateStore 存取。memory 後端只在單一程序內有效；
+# sqlite 後端讓 bot 程序與多個 GPS worker (python main.py --gps-worker) 共用同一份狀態。
+
+class StateStore:
+    """執行期共享狀態的介面。
+
+    GPS session 的 async 方法在 event loop 中呼叫；claim_gps_session 由 Flask 執行緒同步呼叫。
+    """
+
+    shared = False      # 是否可跨程序共用
+
+    def open(self): pass
+    def close(self): pass
+
+    def map(self, namespace):
+        """回傳一個以 namespace 區隔、值可 JSON 序列化的 dict 介面 (讀寫都不做 I/O)。"""
+        raise NotImplementedError
+
+    async def put_gps_session(self, sid, uname, check_type, chat_id, owner, expires_at): raise NotImplementedError
+
+    def claim_gps_session(self, sid, result, now):
+        """原子地寫入 GPS 回傳：回傳 "ok" / "unknown" / "expired" / "duplicate"。"""
+        raise NotImplementedError
+
+    async def take_gps_results(self, owner):
+        """取回屬於 owner、尚未取回過的 GPS 回傳 (每筆只會回傳一次)。"""
+        raise NotImplementedError
+
+    def delete_gps_session(self, sid):
+        """刪除 session；不等待結果，可在持有其他 lock 時呼叫。"""
+        raise NotImplementedError
+
+    async def purge_gps_sessions(self, now): raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    """單一程序的狀態：一般 dict，GPS session 以 lock 保護 (Flask 執行緒與 event loop 共用)。"""
+
+    def __init__(self):
+        self._maps = {}
+        self._gps = {}      # sid -> [owner, expires_at, result, taken]
+        self._lock = threading.Lock()
+
+    def map(self, namespace):
+        return self._maps.setdefault(namespace, {})
+
+    async def put_gps_session(self, sid, uname, check_type, chat_id, owner, expires_at):
+        with self._lock:
+            self._gps[sid] = [owner, expires_at, None, False]
+
+    def claim_gps_session(self, sid, result, now):
+        with self._lock:
+            entry = self._gps.get(sid)
+            if entry is None:
+                return "unknown"
+            if now >= entry[1]:
+                return "expired"
+            if entry[2] is not None:
+                return "duplicate"
+            entry[2] = result
+        return "ok"
+
+    async def take_gps_results(self, owner):
+        with self._lock:
+            taken = {sid: e[2] for sid, e in self._gps.items() if e[0] == owner and e[2] is not None and not e[3]}
+            for sid in taken:
+                self._gps[sid][3] = True
+        return taken
+
+    def delete_gps_session(self, sid):
+        with self._lock:
+            self._gps.pop(sid, None)
+
+    async def purge_gps_sessions(self, now):
+        with self._lock:
+            for sid in [sid for sid, e in self._gps.items() if e[1] <= now]:
+                del self._gps[sid]
+
+
+class SqliteStateMap(MutableMapping):
+    """StateStore.map 的 SQLite 版本：讀取走記憶體中的副本，寫入在背景寫回 kv 表。
+
+    這些 map 只有 bot 程序會讀寫，資料庫只用來在重啟後恢復，因此熱路徑上不查詢資料庫。
+    修改巢狀欄位後需重新指定 (m[key] = value) 才會寫回。
+    """
+
+    def __init__(self, store, namespace):
+        self._store = store
+        self._namespace = namespace
+        self._data = {}
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        payload = json.dumps(value, ensure_ascii=False)     # 在呼叫端序列化，之後的修改不影響寫入內容
+        self._data[key] = value
+        self._store._submit(self._store._io_execute,
+                            "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                            (self._namespace, key, payload))
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._store._submit(self._store._io_execute,
+                            "DELETE FROM kv WHERE namespace = ? AND key = ?", (self._namespace, key))
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _log_state_failure(future):
+    if not future.cancelled() and future.exception():
+        print(f"[State Error] Background state write failed: {future.exception()}")
+
+
+class SqliteStateStore(StateStore):
+    """以 SQLite (WAL) 檔案在多個程序間共用狀態；GPS 回傳以單一 UPDATE 原子認領。
+
+    event loop 上的操作都交給單一執行緒的 executor (自己的連線)，資料庫被鎖住時只會卡住該執行緒；
+    Flask 執行緒的認領使用另一條連線 (以 lock 保護)。
+    """
+
+    shared = True
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS kv (
+            namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+            PRIMARY KEY (namespace, key))""",
+        """CREATE TABLE IF NOT EXISTS gps_sessions (
+            sid TEXT PRIMARY KEY, username TEXT, check_type TEXT, chat_id INTEGER,
+            owner TEXT, expires_at REAL, result TEXT, taken INTEGER NOT NULL DEFAULT 0)""",
+    ]
+    # 建立在欄位遷移之後的索引：只涵蓋尚未被擁有者取回的回傳
+    INDEXES = [
+        "DROP INDEX IF EXISTS idx_gps_owner",
+        "CREATE INDEX IF NOT EXISTS idx_gps_untaken ON gps_sessions(owner) WHERE result IS NOT NULL AND taken = 0",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None        # Flask 執行緒使用
+        self._lock = threading.Lock()
+        self._io = None         # event loop 的狀態操作
+        self._io_conn = None    # 只在 _io 執行緒中使用
+        self._maps = {}
+
+    def _connect(self):
+        # 每個程序、每個執行緒各自一條連線；timeout 讓多個寫入者短暫互相等待而不是直接失敗
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _open_io_conn(self):
+        self._io_conn = self._connect()
+
+    def _close_io_conn(self):
+        self._io_conn.close()
+        self._io_conn = None
+
+    def open(self):
+        self.conn = self._connect()
+        for stmt in self.SCHEMA:
+            self.conn.execute(stmt)
+        if "taken" not in {r["name"] for r in self.conn.execute("PRAGMA table_info(gps_sessions)")}:
+            self.conn.execute("ALTER TABLE gps_sessions ADD COLUMN taken INTEGER NOT NULL DEFAULT 0")
+        for stmt in self.INDEXES:
+            self.conn.execute(stmt)
+        self.conn.commit()
+        for row in self.conn.execute("SELECT namespace, key, value FROM kv"):
+            if row["namespace"] in self._maps:
+                self._maps[row["namespace"]]._data[row["key"]] = json.loads(row["value"])
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state", initializer=self._open_io_conn)
+
+    def close(self):
+        if self._io is not None:
+            # 先寫完佇列中的背景寫入再關閉連線
+            self._io.submit(self._close_io_conn)
+            self._io.shutdown(wait=True)
+            self._io = None
+        if self.conn is not None:
+            with self._lock:
+                self.conn.close()
+                self.conn = None
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self.conn.execute(sql, params)
+            self.conn.commit()
+            return cursor.rowcount
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(r) for r in self.conn.execute(sql, params).fetchall()]
+
+    def _io_execute(self, sql, params=()):
+        cursor = self._io_conn.execute(sql, params)
+        self._io_conn.commit()
+        return cursor.rowcount
+
+    def _io_query(self, sql, params=()):
+        return [dict(r) for r in self._io_conn.execute(sql, params).fetchall()]
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._io, func, *args)
+
+    def _submit(self, func, *args):
+        """排入背景執行、不等待結果；失敗只記錄。"""
+        self._io.submit(func, *args).add_done_callback(_log_state_failure)
+
+    def map(self, namespace):
+        return self._maps.setdefault(namespace, SqliteStateMap(self, namespace))
+
+    async def put_gps_session(self, sid, uname, check_type, chat_id, owner, expires_at):
+        await self._run(self._io_execute,
+                        "INSERT INTO gps_sessions (sid, username, check_type, chat_id, owner, expires_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", (sid, uname, check_type, chat_id, owner, expires_at))
+
+    def claim_gps_session(self, sid, result, now):
+        claimed = self._execute("UPDATE gps_sessions SET result = ? WHERE sid = ? AND result IS NULL AND expires_at > ?",
+                                (json.dumps(result), sid, now))
+        if claimed:
+            return "ok"
+        rows = self._query("SELECT expires_at, result FROM gps_sessions WHERE sid = ?", (sid,))
+        if not rows:
+            return "unknown"
+        return "duplicate" if rows[0]["result"] is not None else "expired"
+
+    def _take_gps_results(self, owner):
+        rows = self._io_conn.execute("SELECT sid, result FROM gps_sessions "
+                                     "WHERE owner = ? AND result IS NOT NULL AND taken = 0", (owner,)).fetchall()
+        if rows:
+            # 以 sid 標記，避免把 SELECT 之後才被認領的回傳一併標成已取回
+            self._io_conn.executemany("UPDATE gps_sessions SET taken = 1 WHERE sid = ?", [(r["sid"],) for r in rows])
+            self._io_conn.commit()
+        return {r["sid"]: json.loads(r["result"]) for r in rows}
+
+    async def take_gps_results(self, owner):
+        return await self._run(self._take_gps_results, owner)
+
+    def delete_gps_session(self, sid):
+        self._submit(self._io_execute, "DELETE FROM gps_sessions WHERE sid = ?", (sid,))
+
+    async def purge_gps_sessions(self, now):
+        await self._run(self._io_execute, "DELETE FROM gps_sessions WHERE expires_at <= ?", (now,))
+
+
+def create_state_store(backend):
+    if backend == "sqlite":
+        return SqliteStateStore(STATE_DB_FILE)
+    if backend != "memory":
+        print(f"[Warning] Unknown STATE_BACKEND '{backend}', falling back to memory.")
+    return MemoryStateStore()
+
+
+state = create_state_store(STATE_BACKEND)
+pending_leave = state.map("pending_leave")          # 暫存請假申請 (待審核)
+forwarding_users = state.map("forwarding_users")    # 用來判斷誰的筆記要轉發
+
+
+# ==== GPS 簽章 token ====
+# session id 即簽章 token：內含 username、打卡類型、chat id 與簽發時間，任何 worker 都能
+# 不查表、以常數時間驗證簽章並拒絕偽造或過期的請求；重複送出則由 StateStore 的認領擋下。
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _gps_token_mac(payload):
+    return hmac.new(GPS_TOKEN_KEY, payload.encode("ascii"), hashlib.sha256).digest()[:GPS_TOKEN_MAC_BYTES]
+
+def issue_gps_token(uname, check_type, chat_id, issued_at=None):
+    """簽發 GPS token：base64url(payload).base64url(HMAC-SHA256)。"""
+    issued_at = int(issued_at if issued_at is not None else time_mod.time())
+    payload = _b64encode(f"{uname}:{check_type}:{chat_id}:{issued_at}:{secrets.token_hex(4)}".encode("utf-8"))
+    return f"{payload}.{_b64encode(_gps_token_mac(payload))}"
+
+def verify_gps_token(token, now=None):
+    """驗證 GPS token：回傳 (狀態, claims)，狀態為 "ok" / "invalid" / "expired"。"""
+    try:
+        payload, mac = token.split(".")
+        valid = hmac.compare_digest(_b64decode(mac), _gps_token_mac(payload))
+    except (ValueError, UnicodeEncodeError):
+        return "invalid", None
+    if not valid:
+        return "invalid", None
+    uname, check_type, chat_id, issued_at, _ = _b64decode(payload).decode("utf-8").split(":")
+    claims = {"uname": uname, "check_type": check_type, "chat_id": int(chat_id), "issued_at": int(issued_at)}
+    now = time_mod.time() if now is None else now
+    if now >= claims["issued_at"] + GPS_TIMEOUT_SECONDS:
+        return "expired", claims
+    return "ok", claims
+
+
+class GpsSession:
+    """一次打卡流程的 GPS session。"""
+    __slots__ = ("sid", "uname", "check_type", "chat_id", "expires_at", "future", "submitted")
+
+    def __init__(self, sid, uname, check_type, chat_id, expires_at, future):
+        self.sid = sid
+        self.uname = uname
+        self.check_type = check_type
+        self.chat_id = chat_id
+        self.expires_at = expires_at
+        self.future = future
+        self.submitted = False
+
+
+class GpsSessionStore:
+    """有 TTL 上限的 GPS session 存放區，Flask 執行緒與 bot event loop 共用 (以 lock 保護)。
+
+    只接受由 bot 發出且尚未過期的 session；過期由單一背景 task 依 min-heap 處理，
+    過期時以 None 完成 session 的 Future，等待中的打卡流程即可回報逾時。
+    session 的認領記錄在 StateStore；共用後端時，其他程序 (GPS worker) 收到的回傳
+    由背景 task 定期取回。同一使用者同一種打卡 (上班/下班) 同時只會有一個進行中的 session。
+    """
+
+    def __init__(self, ttl, max_sessions, state_store):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.state = state_store
+        self.owner = secrets.token_hex(8)   # 本程序的識別，用來取回屬於自己的 GPS 回傳
+        self._sessions = {}     # sid -> GpsSession
+        self._by_key = {}       # (uname, check_type) -> sid，進行中的 session
+        self._heap = []         # (expires_at, sid)，惰性刪除
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._has_sessions = None   # 有等待中的 session 時才輪詢共用後端
+        self._tasks = []
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._has_sessions = asyncio.Event()
+        self._tasks.append(asyncio.create_task(self._sweeper()))
+        if self.state.shared:
+            self._tasks.append(asyncio.create_task(self._poll_results()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def open(self, uname, check_type, chat_id):
+        """取得 (session, 是否新建立)：同一使用者同一種打卡已有進行中的 session 就沿用 (需在 event loop 中呼叫)。"""
+        now = time_mod.monotonic()
+        with self._lock:
+            session = self._sessions.get(self._by_key.get((uname, check_type)))
+            if session is not None and (session.submitted or session.expires_at > now):
+                return session, False
+        return await self.create(uname, check_type, chat_id), True
+
+    async def create(self, uname, check_type, chat_id):
+        """建立新 session (需在 event loop 中呼叫)；登記到 StateStore 失敗時撤銷並拋出例外。"""
+        now = time_mod.monotonic()
+        session = GpsSession(issue_gps_token(uname, check_type, chat_id), uname, check_type, chat_id,
+                             now + self.ttl, self._loop.create_future())
+        with self._lock:
+            while len(self._sessions) >= self.max_sessions:
+                self._expire_earliest_locked()
+            self._sessions[session.sid] = session
+            self._by_key[(uname, check_type)] = session.sid
+            heapq.heappush(self._heap, (session.expires_at, session.sid))
+            is_earliest = self._heap[0][1] == session.sid
+        try:
+            await self.state.put_gps_session(session.sid, uname, check_type, chat_id, self.owner,
+                                             time_mod.time() + self.ttl)
+        except Exception:
+            with self._lock:
+                self._forget_locked(session.sid)
+            raise
+        if is_earliest:
+            self._wakeup.set()
+        self._has_sessions.set()
+        return session
+
+    def discard(self, sid):
+        with self._lock:
+            self._forget_locked(sid)
+        self.state.delete_gps_session(sid)
+
+    def _forget_locked(self, sid):
+        session = self._sessions.pop(sid, None)
+        if session is not None and self._by_key.get((session.uname, session.check_type)) == sid:
+            del self._by_key[(session.uname, session.check_type)]
+        return session
+
+    def submit(self, sid, session_data):
+        """由 Flask 執行緒呼叫 (任一程序)：回傳 "ok" / "unknown" / "expired" / "duplicate"。"""
+        # 先驗簽章與期限：偽造或過期的 token 不必碰到 StateStore
+        status, _ = verify_gps_token(sid)
+        if status != "ok":
+            return "unknown" if status == "invalid" else "expired"
+        result = self.state.claim_gps_session(sid, {**session_data, "timestamp": session_data["timestamp"].isoformat()},
+                                              time_mod.time())
+        if result != "ok":
+            return result
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is not None:
+                session.submitted = True
+        # session 屬於本程序時直接喚醒；否則由擁有者的 _poll_results 取回
+        if session is not None:
+            # Flask 跑在獨立執行緒，必須透過 call_soon_threadsafe 交給 bot 的 event loop 處理
+            self._loop.call_soon_threadsafe(self._resolve, session, session_data)
+        return "ok"
+
+    @staticmethod
+    def _resolve(session, result):
+        if not session.future.done():
+            session.future.set_result(result)
+
+    def _expire_earliest_locked(self):
+        while self._heap:
+            _, sid = heapq.heappop(self._heap)
+            session = self._forget_locked(sid)
+            if session is not None:
+                self.state.delete_gps_session(sid)
+                self._loop.call_soon_threadsafe(self._resolve, session, None)
+                return
+
+    async def _sweeper(self):
+        while True:
+            expired = []
+            with self._lock:
+                now = time_mod.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    _, sid = heapq.heappop(self._heap)
+                    session = self._sessions.get(sid)
+                    if session is not None and not session.submitted:
+                        self._forget_locked(sid)
+                        expired.append(session)
+                delay = self._heap[0][0] - now if self._heap else None
+            for session in expired:
+                self.state.delete_gps_session(session.sid)
+                self._resolve(session, None)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll_results(self):
+        """共用後端：本程序有等待中的 session 時，取回其他程序代收的 GPS 回傳，並清掉已失效程序留下的過期 session。"""
+        last_purge = 0.0
+        while True:
+            if not self._sessions:
+                self._has_sessions.clear()
+                await self._has_sessions.wait()
+            await asyncio.sleep(GPS_RESULT_POLL_SECONDS)
+            try:
+                results = await self.state.take_gps_results(self.owner)
+                for sid, data in results.items():
+                    with self._lock:
+                        session = self._sessions.get(sid)
+                        if session is not None:
+                            session.submitted = True
+                    if session is not None:
+                        self._resolve(session, {**data, "timestamp": datetime.fromisoformat(data["timestamp"])})
+                if time_mod.time() - last_purge >= self.ttl:
+                    last_purge = time_mod.time()
+                    await self.state.purge_gps_sessions(last_purge)
+            except Exception as e:
+                print(f"[Error] Failed to poll GPS results: {e}")
+
+
+gps_store = GpsSessionStore(GPS_TIMEOUT_SECONDS, GPS_MAX_SESSIONS, state)
+
 
 @flask_app.route("/submit", methods=["POST"])
 def gps_submit():
     try:
-        data = request.get_json()
-        if not all(k in data for k in ["session_id", "lat", "lon"]):
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not all(k in data for k in ["session_id", "lat", "lon"]):
+            return "Invalid data", 400
+        try:
+            lat, lon = float(data["lat"]), float(data["lon"])
+        except (TypeError, ValueError):
             return "Invalid data", 400
+        if bot_loop is None and not state.shared:
+            return "Bot not ready", 503
 
-        gps_sessions[data["session_id"]] = {
-            "lat": data["lat"],
-            "lon": data["lon"],
-            "timestamp": datetime.now(),
-            "done": True
+        session_data = {
+            "lat": lat,
+            "lon": lon,
+            "timestamp": datetime.now()
         }
+        result = gps_store.submit(str(data["session_id"]), session_data)
+        if result == "unknown":
+            return "Unknown session", 404
+        if result in ("expired", "duplicate"):
+            return "Session expired", 410
         return "ok"
     except Exception as e:
         print(f"[Flask Error] /submit failed: {e}")
         return "Internal server error", 500
 
 
+@flask_app.route("/metrics")
+def metrics_endpoint():
+    if not METRICS_TOKEN:
+        return "Not found", 404
+    auth = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth.encode("utf-8"), f"Bearer {METRICS_TOKEN}".encode("utf-8")):
+        return Response("Unauthorized", status=401, headers={"WWW-Authenticate": "Bearer"})
+    return Response(metrics.render(), status=200, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@flask_app.route(TELEGRAM_WEBHOOK_PATH, methods=["POST"])
+def telegram_webhook():
+    """Webhook 模式：驗證 secret token 後直接把更新放進 Application 的佇列。"""
+    if telegram_app is None or bot_loop is None:
+        return "Bot not ready", 503
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token.encode("utf-8"), TELEGRAM_WEBHOOK_SECRET.encode("utf-8")):
+        return "Forbidden", 403
+    data = request.get_json(silent=True)
+    if not data:
+        return "Invalid data", 400
+    try:
+        update = Update.de_json(data, telegram_app.bot)
+        bot_loop.call_soon_threadsafe(telegram_app.update_queue.put_nowait, update)
+        return "ok"
+    except Exception as e:
+        print(f"[Flask Error] Webhook update failed: {e}")
+        return "Internal server error", 500
+
+
 def run_flask():
     # FIX: 關閉 Flask 的除錯模式，在生產環境中更安全
-    flask_app.run(host="0.0.0.0", port=5005, debug=False)
+    flask_app.run(host="0.0.0.0", port=FLASK_PORT, debug=False)
 
-# 啟動 Flask 在背景執行
-threading.Thread(target=run_flask, daemon=True).start()
+def run_gps_worker():
+    """只提供 GPS 頁面與 /submit 的程序，可與 bot 程序分開部署或同時跑多個 (需 STATE_BACKEND=sqlite)。"""
+    if not state.shared:
+        print("[Fatal] --gps-worker requires STATE_BACKEND=sqlite.")
+        return
+    state.open()
+    try:
+        run_flask()
+    finally:
+        state.close()
 
 
 # ========== Telegram 機器人部分 ==========
 
 def load_users():
-    """從 users.csv 讀取使用者資料，若不存在就建立。"""
+    """透過儲存層讀取使用者資料。"""
     global users
-    users = {}
-    if not os.path.exists(USERS_CSV_FILE):
-        header = ["username", "name", "lat", "lon", "address", "role", "user_id"]
-        ensure_csv_header(USERS_CSV_FILE, header)
-        return
+    users = storage.load_users()
 
-    try:
-        with open(USERS_CSV_FILE, mode="r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                uname = row["username"].strip().lower()
-                if not uname:
-                    continue
-                try:
-                    lat = float(row.get("lat", 0))
-                    lon = float(row.get("lon", 0))
-                except (ValueError, TypeError):
-                    lat, lon = 0.0, 0.0
-
-                user_id = int(row["user_id"]) if row.get("user_id", "").isdigit() else None
-
-                users[uname] = {
-                    "name": row.get("name", ""), "lat": lat, "lon": lon,
-                    "address": row.get("address", "未知"),
-                    "role": row.get("role", "employee").strip().lower(),
-                    "user_id": user_id,
-                    "checkin_full": None, "checkout_full": None # FIX: 移除 checkin/checkout，只用 full datetime 物件
-                }
-    except Exception as e:
-        print(f"[Error] Failed to load users.csv: {e}")
 
+def save_users():
+    """將使用者登錄表透過儲存層回寫。"""
+    storage.save_users(users.values())
 
-def save_users_to_csv():
-    """將 users dict 回寫到 users.csv。"""
-    global users
-    fieldnames = ["username", "name", "lat", "lon", "address", "role", "user_id"]
-    try:
-        with open(USERS_CSV_FILE, "w", encoding="utf-8", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            for uname, udata in users.items():
-                writer.writerow({
-                    "username": uname,
-                    "name": udata.get("name", ""),
-                    "lat": udata.get("lat", ""),
-                    "lon": udata.get("lon", ""),
-                    "address": udata.get("address", ""),
-                    "role": udata.get("role", "employee"),
-                    "user_id": udata.get("user_id", "")
-                })
-    except Exception as e:
-        print(f"[Error] Failed to save users.csv: {e}")
+def _apply_attendance_row(row):
+    """把一筆今日出勤紀錄套用到使用者登錄表的狀態與今日看板。"""
+    today_board.record_row(row)
+    uname = row["username"]
+    if uname in users:
+        timestamp = datetime.fromisoformat(row["timestamp"])
+        if row["type"] == "in":
+            users.set_checkin(uname, timestamp)
+        elif row["type"] == "out":
+            users.set_checkout(uname, timestamp)
 
 # FIX: 新增函式，在啟動時從 log 檔恢復今日打卡狀態
 def restore_today_status():
-    """從 attendance_log.csv 讀取今日紀錄，恢復 users dict 中的狀態。"""
+    """從出勤紀錄讀取今日資料 (索引查詢)，恢復使用者登錄表中的狀態。"""
     today_str = datetime.now().strftime("%Y-%m-%d")
-    if not os.path.exists(ATTENDANCE_CSV):
-        return
     try:
-        with open(ATTENDANCE_CSV, "r", encoding="utf-8", newline="") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row["date"] == today_str:
-                    uname = row["username"]
-                    if uname in users:
-                        timestamp = datetime.fromisoformat(row["timestamp"])
-                        if row["type"] == "in":
-                            users[uname]["checkin_full"] = timestamp
-                        elif row["type"] == "out":
-                            users[uname]["checkout_full"] = timestamp
+        for row in storage.read_attendance(today_str, today_str):
+            _apply_attendance_row(row)
         print("[Info] Today's attendance status restored from log.")
     except Exception as e:
         print(f"[Error] Failed to restore today's status: {e}")
 
+
+# ==== 狀態快照 (快速啟動) ====
+def _iso_or_none(value):
+    return value.isoformat() if value else None
+
+async def write_state_snapshot():
+    """把使用者、今日打卡狀態、待審假單與出勤紀錄位置寫成快照。"""
+    # 先取位置再複製狀態：位置之後的紀錄在啟動時會重播，重播是冪等的
+    offset = await storage.attendance_offset()
+    snapshot = {
+        "saved_at": datetime.now().isoformat(),
+        "date": datetime.now().strftime("%Y-%m-%d"),
+        "users_signature": storage.users_signature(),
+        "users": {
+            uname: {
+                **record.to_row(),
+                "checkin_full": _iso_or_none(record.checkin_full),
+                "checkout_full": _iso_or_none(record.checkout_full),
+            }
+            for uname, record in users.items()
+        },
+        "pending_leave": dict(pending_leave),
+        "today_board": today_board.to_dict(),
+        "log_offset": offset,
+    }
+    payload = json.dumps(snapshot, ensure_ascii=False)
+
+    def _write():
+        tmp_path = STATE_SNAPSHOT_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp_path, STATE_SNAPSHOT_FILE)
+
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, _write)
+    except Exception as e:
+        print(f"[Error] Failed to write state snapshot: {e}")
+
+def _restore_pending_leave(entries):
+    """快照可能比實際狀態舊：只恢復儲存層中仍為 pending 的假單；共用後端已有資料時以後端為準。"""
+    if state.shared and len(pending_leave):
+        return
+    statuses = {r["request_id"]: r.get("status") for r in storage.read_leave()}
+    for request_id, info in entries.items():
+        if statuses.get(request_id) == "pending":
+            pending_leave[request_id] = info
+
+def restore_from_snapshot():
+    """從快照恢復狀態，只重播快照之後新增的出勤紀錄。快照不可用時回傳 False。"""
+    global users
+    if not os.path.exists(STATE_SNAPSHOT_FILE):
+        return False
+    try:
+        with open(STATE_SNAPSHOT_FILE, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except Exception as e:
+        print(f"[Error] Failed to read state snapshot: {e}")
+        return False
+
+    signature = storage.users_signature()
+    if signature is not None and signature == snapshot.get("users_signature"):
+        users = UserRegistry(UserRecord.from_row(row, uname) for uname, row in snapshot["users"].items())
+    else:
+        load_users()
+    _restore_pending_leave(snapshot.get("pending_leave", {}))
+
+    if snapshot.get("date") != datetime.now().strftime("%Y-%m-%d"):
+        restore_today_status()     # 快照不是今天的，今日狀態改由日期索引恢復
+        return True
+
+    today_board.load_dict(snapshot.get("today_board") or {})
+    for uname, row in snapshot["users"].items():
+        if uname in users:
+            if row.get("checkin_full"):
+                users.set_checkin(uname, datetime.fromisoformat(row["checkin_full"]))
+            if row.get("checkout_full"):
+                users.set_checkout(uname, datetime.fromisoformat(row["checkout_full"]))
+
+    rows, _ = storage.read_attendance_since(snapshot.get("log_offset", 0))
+    if rows is None:
+        restore_today_status()
+        return True
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    for row in rows:
+        if row["date"] == today_str:
+            _apply_attendance_row(row)
+    print(f"[Info] State restored from snapshot ({len(rows)} log rows replayed).")
+    return True
+
 def haversine(lat1, lon1, lat2, lon2):
     """計算兩點之間的距離（公尺）。"""
     R = 6371000
@@ -497,175 +2401,904 @@ def haversine(lat1, lon1, lat2, lon2):
     a = sin(dlat / 2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2)**2
     return 2 * R * asin(sqrt(a))
 
-def get_address(lat, lon):
+
+class SiteRegistry:
+    """允許打卡的地點清單 (sites.csv)，每個地點可指派給使用者、團隊或所有人。
+
+    sites.csv 欄位：site_id, name, lat, lon, radius_m, assignees
+    assignees 以空白分隔：使用者名稱、team:<團隊> 或 * (所有人)；留空視為所有人。
+    到所有候選地點的距離以 NumPy 一次計算；地點數量很多時先以經緯度網格縮小範圍。
+    """
+
+    EARTH_RADIUS = 6371000
+
+    def __init__(self, path, default_radius, grid_threshold, cell_deg):
+        self.path = path
+        self.default_radius = default_radius
+        self.grid_threshold = grid_threshold
+        self.cell_deg = cell_deg
+        self._reset()
+
+    def _reset(self):
+        self.ids, self.names, self.lats, self.lons, self.radii = [], [], [], [], []
+        self.by_user, self.by_team, self.shared = {}, {}, []
+        self.grid = None
+        self._lat_rad = self._lon_rad = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self):
+        self._reset()
+        try:
+            rows = read_csv_dicts(self.path)
+        except Exception as e:
+            print(f"[Error] Failed to load {self.path}: {e}")
+            return
+        for row in rows:
+            try:
+                lat, lon = float(row["lat"]), float(row["lon"])
+                radius = float(row.get("radius_m") or self.default_radius)
+            except (KeyError, TypeError, ValueError):
+                continue
+            i = len(self.ids)
+            self.ids.append(row.get("site_id") or str(i))
+            self.names.append(row.get("name") or self.ids[-1])
+            self.lats.append(lat)
+            self.lons.append(lon)
+            self.radii.append(radius)
+            for assignee in (row.get("assignees") or "*").split():
+                assignee = assignee.lstrip("@").lower()
+                if assignee == "*":
+                    self.shared.append(i)
+                elif assignee.startswith("team:"):
+                    self.by_team.setdefault(assignee[5:], []).append(i)
+                else:
+                    self.by_user.setdefault(assignee, []).append(i)
+        if np is not None and self.ids:
+            self._lat_rad = np.radians(np.array(self.lats))
+            self._lon_rad = np.radians(np.array(self.lons))
+        if len(self.ids) >= self.grid_threshold:
+            self.grid = {}
+            for i, (lat, lon) in enumerate(zip(self.lats, self.lons)):
+                self.grid.setdefault(self._cell(lat, lon), []).append(i)
+        if self.ids:
+            print(f"[Info] Loaded {len(self.ids)} sites from {self.path}.")
+
+    def _cell(self, lat, lon):
+        return floor(lat / self.cell_deg), floor(lon / self.cell_deg)
+
+    def candidates(self, uname, team):
+        idx = set(self.shared)
+        idx.update(self.by_user.get(uname, ()))
+        if team:
+            idx.update(self.by_team.get(team, ()))
+        return sorted(idx)
+
+    def _distances(self, lat, lon, idx):
+        """一次算出 (lat, lon) 到 idx 中所有地點的距離 (公尺)。"""
+        if np is None:
+            return [haversine(lat, lon, self.lats[i], self.lons[i]) for i in idx]
+        idx = np.asarray(idx, dtype=np.intp)
+        plat, plon = np.radians(lat), np.radians(lon)
+        site_lat = self._lat_rad[idx]
+        dlat = site_lat - plat
+        dlon = self._lon_rad[idx] - plon
+        a = np.sin(dlat / 2) ** 2 + np.cos(plat) * np.cos(site_lat) * np.sin(dlon / 2) ** 2
+        return 2 * self.EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+    def _nearest_in(self, lat, lon, idx):
+        if not idx:
+            return None, float("inf")
+        dists = self._distances(lat, lon, idx)
+        best = min(range(len(idx)), key=dists.__getitem__) if np is None else int(np.argmin(dists))
+        return idx[best], float(dists[best])
+
+    def _nearest_with_grid(self, lat, lon, candidate_set, max_rings=20):
+        """由內而外逐圈搜尋網格；找到的最近距離小於未搜尋區域的最短距離即可停止。"""
+        ci, cj = self._cell(lat, lon)
+        ring_m = self.cell_deg * 111320 * max(cos(radians(lat)), 0.01)
+        best_i, best_d = None, float("inf")
+        for r in range(max_rings + 1):
+            ring = [
+                i
+                for di in range(-r, r + 1) for dj in range(-r, r + 1)
+                if max(abs(di), abs(dj)) == r
+                for i in self.grid.get((ci + di, cj + dj), ())
+                if i in candidate_set
+            ]
+            i, d = self._nearest_in(lat, lon, ring)
+            if d < best_d:
+                best_i, best_d = i, d
+            if best_i is not None and best_d <= r * ring_m:
+                return best_i, best_d
+        return self._nearest_in(lat, lon, sorted(candidate_set))
+
+    def locate(self, uname, profile, lat, lon):
+        """找出離打卡位置最近的允許地點，回傳 {site_id, name, distance, inside}。"""
+        best = None
+        if profile.lat or profile.lon:
+            d = haversine(lat, lon, profile.lat, profile.lon)
+            best = {"site_id": "home", "name": "登記地點", "distance": d, "inside": d <= self.default_radius}
+
+        idx = self.candidates(uname, profile.team)
+        if idx:
+            if self.grid is not None and len(idx) >= self.grid_threshold:
+                i, d = self._nearest_with_grid(lat, lon, set(idx))
+            else:
+                i, d = self._nearest_in(lat, lon, idx)
+            if i is not None and (best is None or d < best["distance"]):
+                best = {"site_id": self.ids[i], "name": self.names[i], "distance": d, "inside": d <= self.radii[i]}
+
+        if best is None:
+            best = {"site_id": "", "name": "未設定", "distance": 0.0, "inside": False}
+        return best
+
+
+site_registry = SiteRegistry(SITES_CSV, SITE_DEFAULT_RADIUS_M, SITE_GRID_THRESHOLD, SITE_GRID_CELL_DEG)
+
+def fetch_address(lat, lon):
+    """呼叫 Google Geocoding API，回傳 (地址, 是否可快取)。"""
     if not Maps_API_KEY or "YOUR_Maps_API_KEY" in Maps_API_KEY:
-        return "無法取得地址 (API金鑰未設定)"
+        return "無法取得地址 (API金鑰未設定)", False
 
-    url = "https://maps.googleapis.com/maps/api/geocode/json"
+    url = GEOCODE_API_URL
     params = {
         "latlng": f"{lat},{lon}",
         "key": Maps_API_KEY,
         "language": "zh-TW"
     }
+    started, outcome = time_mod.perf_counter(), "ok"
     try:
         res = requests.get(url, params=params, timeout=10)    # ← 這裡加上 params
         res.raise_for_status()
         data = res.json()
         if data["status"] == "OK" and data["results"]:
-            return data["results"][0]["formatted_address"]
+            return data["results"][0]["formatted_address"], True
         else:
-            return f"無法取得地址 (API錯誤: {data.get('status', 'Unknown')})"
+            outcome = "api_error"
+            return f"無法取得地址 (API錯誤: {data.get('status', 'Unknown')})", False
     except requests.RequestException as e:
+        outcome = "request_failed"
         print(f"[API Error] Geocoding request failed: {e}")
-        return "無法取得地址 (請求失敗)"
+        return "無法取得地址 (請求失敗)", False
+    finally:
+        EXTERNAL_SECONDS.observe(time_mod.perf_counter() - started, service="geocode", method="reverse")
+        EXTERNAL_REQUESTS.inc(service="geocode", method="reverse", outcome=outcome)
 
+def get_address(lat, lon):
+    return fetch_address(lat, lon)[0]
+
+
+class GeocodeCache:
+    """以量化座標為 key 的反向地理編碼快取：TTL + LRU 淘汰、持久化到磁碟、同格查詢只打一次 API。"""
+
+    def __init__(self, path, ttl, max_entries, decimals):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.decimals = decimals
+        self._entries = OrderedDict()   # key -> (address, fetched_at)，由舊到新
+        self._inflight = {}             # key -> asyncio.Future (single-flight)
+        self._pinned = {}               # key -> address，預熱釘住的地點：不過期、不被 LRU 淘汰
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.joins = 0                  # 加入進行中查詢的次數 (沒打 API，但也不是快取命中)
+
+    def cell_key(self, lat, lon):
+        d = self.decimals
+        return f"{round(float(lat), d):.{d}f},{round(float(lon), d):.{d}f}"
+
+    def get(self, key):
+        pinned = self._pinned.get(key)
+        if pinned is not None:
+            return pinned
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        address, fetched_at = entry
+        if time_mod.time() - fetched_at > self.ttl:
+            del self._entries[key]
+            self._dirty = True
+            return None
+        self._entries.move_to_end(key)
+        return address
+
+    def put(self, key, address):
+        self._entries[key] = (address, time_mod.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def peek(self, lat, lon):
+        """只查快取 (不打 API)；未命中回傳 None。"""
+        address = self.get(self.cell_key(lat, lon))
+        if address is not None:
+            self.hits += 1
+        return address
+
+    async def lookup(self, lat, lon):
+        """回傳地址；命中快取直接回傳，否則在 executor 查詢 API，同一格的並行查詢共用結果。"""
+        key = self.cell_key(lat, lon)
+        address = self.get(key)
+        if address is not None:
+            self.hits += 1
+            return address
+        address, _ = await self._fetch(key, lat, lon)
+        return address
+
+    async def _fetch(self, key, lat, lon):
+        """不看快取直接查詢 API (single-flight)，可快取的結果寫入快取；回傳 (地址, 是否可快取)。"""
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.joins += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._inflight[key] = future
+        try:
+            address, cacheable = await loop.run_in_executor(None, fetch_address, lat, lon)
+            if cacheable:
+                self.put(key, address)
+            future.set_result((address, cacheable))
+            return address, cacheable
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()      # 標記為已取回，沒有其他等待者時不會出現 "Future exception was never retrieved"
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def pin(self, lat, lon):
+        """重新查詢並釘住該地點的地址；查詢失敗時保留原本釘住的地址。回傳是否成功取得可快取的地址。"""
+        key = self.cell_key(lat, lon)
+        address, cacheable = await self._fetch(key, lat, lon)
+        if not cacheable:
+            return False
+        self._pinned[key] = address
+        return True
+
+    def stats(self):
+        total = self.hits + self.misses + self.joins
+        return {
+            "hits": self.hits, "misses": self.misses, "joins": self.joins,
+            "entries": len(self._entries), "pinned": len(self._pinned),
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+
+    def load(self):
+        """從磁碟載入快取，略過已過期的項目。"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            now = time_mod.time()
+            for key, (address, fetched_at) in data.items():
+                if now - fetched_at <= self.ttl:
+                    self._entries[key] = (address, fetched_at)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            print(f"[Info] Geocode cache loaded: {len(self._entries)} entries.")
+        except Exception as e:
+            print(f"[Error] Failed to load {self.path}: {e}")
+
+    def save(self, force=False):
+        """以暫存檔 + os.replace 原子寫回磁碟 (保留 LRU 順序)。"""
+        if not (self._dirty or force):
+            return
+        snapshot = {key: [address, fetched_at] for key, (address, fetched_at) in self._entries.items()}
+        self._dirty = False
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self._dirty = True
+            print(f"[Error] Failed to save {self.path}: {e}")
+
+
+geocode_cache = GeocodeCache(GEOCODE_CACHE_FILE, GEOCODE_CACHE_TTL, GEOCODE_CACHE_MAX_ENTRIES, GEOCODE_GRID_DECIMALS)
+
+
+class HolidayCalendar:
+    """整年假日表：每年一個 bytearray (以一年中的第幾天為索引，1=假日)，查詢 O(1) 且不需網路。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._years = {}    # year -> bytearray
+
+    def is_holiday(self, day):
+        """回傳 True/False；該年份尚未載入時回傳 None (視為無法判斷)。"""
+        table = self._years.get(day.year)
+        if table is None:
+            return None
+        return table[day.timetuple().tm_yday - 1] == 1
+
+    def has_year(self, year):
+        return year in self._years
+
+    @staticmethod
+    def _build_table(year, entries):
+        """把 API 格式的逐日資料轉成 bytearray。"""
+        first_day = datetime(year, 1, 1).date()
+        days_in_year = (datetime(year + 1, 1, 1).date() - first_day).days
+        table = bytearray(days_in_year)
+        for entry in entries:
+            date_str = str(entry.get("date", ""))
+            try:
+                day = datetime.strptime(date_str, "%Y%m%d").date()
+            except ValueError:
+                continue
+            if day.year == year and entry.get("isHoliday"):
+                table[(day - first_day).days] = 1
+        return table
+
+    def load_entries(self, entries):
+        """載入 API 格式的資料 (可包含多個年份)。"""
+        years = {str(e.get("date", ""))[:4] for e in entries}
+        for year_str in years:
+            if year_str.isdigit():
+                year = int(year_str)
+                self._years[year] = self._build_table(year, entries)
+
+    def fetch_year(self, year):
+        """從 API 下載整年行事曆 (阻塞，請在 executor 中執行)。"""
+        started, outcome = time_mod.perf_counter(), "ok"
+        try:
+            res = requests.get(f"{HOLIDAY_API_URL}/{year}", timeout=15)
+            res.raise_for_status()
+            data = res.json()
+            if not isinstance(data, list) or not data:
+                outcome = "api_error"
+                print(f"[Warning] Holiday API returned no data for {year}.")
+                return False
+            self._years[year] = self._build_table(year, data)
+            self.save()
+            print(f"[Info] Holiday calendar for {year} refreshed.")
+            return True
+        except (requests.RequestException, ValueError) as e:
+            outcome = "request_failed"
+            print(f"[Warning] Holiday calendar fetch for {year} failed: {e}")
+            return False
+        finally:
+            EXTERNAL_SECONDS.observe(time_mod.perf_counter() - started, service="holiday", method="year")
+            EXTERNAL_REQUESTS.inc(service="holiday", method="year", outcome=outcome)
+
+    def load(self, source_file=None):
+        """先讀本地快取，再讀離線來源檔 (若有指定)。"""
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                for year_str, bits in data.items():
+                    self._years[int(year_str)] = bytearray(1 if c == "1" else 0 for c in bits)
+            except Exception as e:
+                print(f"[Error] Failed to load {self.path}: {e}")
+        if source_file:
+            try:
+                with open(source_file, "r", encoding="utf-8") as f:
+                    self.load_entries(json.load(f))
+                self.save()
+            except Exception as e:
+                print(f"[Error] Failed to load holiday source file {source_file}: {e}")
+        print(f"[Info] Holiday calendar years loaded: {sorted(self._years)}")
+
+    def save(self):
+        data = {str(year): "".join("1" if b else "0" for b in table) for year, table in sorted(self._years.items())}
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"[Error] Failed to save {self.path}: {e}")
+
+
+holiday_calendar = HolidayCalendar(HOLIDAY_CALENDAR_FILE)
+
+
+# ==== Bot API 監控 ====
+class InstrumentedRequest(HTTPXRequest):
+    """在 PTB 的 HTTP 層記錄每次 Bot API 呼叫的延遲與結果 (涵蓋 reply、send、edit 等所有呼叫)。"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started, outcome = time_mod.perf_counter(), "error"
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            outcome = "ok" if code == 200 else f"http_{code}"
+            return code, payload
+        finally:
+            EXTERNAL_SECONDS.observe(time_mod.perf_counter() - started, service="telegram", method=api_method)
+            EXTERNAL_REQUESTS.inc(service="telegram", method=api_method, outcome=outcome)
+
+
+# ==== 對外訊息排程 ====
+PRIORITY_INTERACTIVE = 0    # 直接回應使用者操作的訊息
+PRIORITY_BROADCAST = 1      # 定時廣播 (提醒、通知)
+
+
+class TokenBucket:
+    """簡單的 token bucket：rate 為每秒補充的 token 數。"""
+
+    def __init__(self, rate, capacity=1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time_mod.monotonic()
+
+    def try_acquire(self):
+        """有 token 就取用並回傳 0，否則回傳還需等待的秒數 (不取用)。"""
+        now = time_mod.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class BroadcastJob:
+    """一次廣播工作的統計：送出數、失敗數與完成時間。"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time_mod.monotonic()
+        self.futures = []
+        self.sent = 0
+        self.failed = 0
+        self.duration = None
+
+
+class OutboundScheduler:
+    """集中的對外訊息排程器：全域與單一聊天室 token bucket 限流、有限併發、
+    互動訊息優先於廣播，遇到 RetryAfter 依指示暫停、網路錯誤則指數退避重試。
+
+    所有會送出或修改訊息的 Bot API 呼叫 (send、reply、edit、forward、傳檔) 都經過這裡，限流才算數。"""
+
+    def __init__(self, concurrency, global_rate, private_rate, group_rate, max_retries):
+        self.concurrency = concurrency
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        self._queue = None
+        self._workers = []
+        self._seq = 0
+        self._unsettled = {}        # seq -> 尚未完成的 item (佇列中、延後重排中或傳送中)
+        self._closed = False
+        self._paused_until = 0.0
+        self.last_jobs = {}         # job 名稱 -> 最近一次的 BroadcastJob
+
+    def start(self):
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def close(self):
+        """停止 worker 並取消所有尚未送出的訊息 (等待中的呼叫端會收到 CancelledError)；之後不再接受新訊息。"""
+        self._closed = True
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                self._queue.get_nowait()
+        for item in list(self._unsettled.values()):
+            self._settle(item, cancelled=True)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # 清掉已補滿 (閒置) 的 bucket，避免無限成長
+                for key in [k for k, b in self._chat_buckets.items() if b.try_acquire() == 0]:
+                    del self._chat_buckets[key]
+            rate = self.group_rate if int(chat_id) < 0 else self.private_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate)
+        return bucket
+
+    def _enqueue(self, priority, seq, item):
+        if self._closed:
+            return      # 關閉後才到期的延後重排：item 已在 close() 中取消
+        self._queue.put_nowait((priority, seq, item))
+
+    def submit(self, chat_id, call, priority=PRIORITY_INTERACTIVE, job=None):
+        """排入一個對 chat_id 的 Bot API 呼叫，回傳可 await 的 Future (結果為 call 的回傳值)。
+
+        call 是不帶參數、回傳 awaitable 的函式 (例如 functools.partial)，重試時會再呼叫一次。
+        排程器關閉後呼叫會拋出 RuntimeError。
+        """
+        if self._closed:
+            raise RuntimeError("OutboundScheduler is closed")
+        future = asyncio.get_running_loop().create_future()
+        if self._queue is None:
+            # 排程器尚未啟動時直接送出
+            task = asyncio.ensure_future(call())
+            task.add_done_callback(lambda t: future.set_exception(t.exception()) if t.exception() else future.set_result(t.result()))
+        else:
+            self._seq += 1
+            item = {"chat_id": chat_id, "call": call,
+                    "future": future, "attempt": 0, "job": job, "seq": self._seq}
+            self._unsettled[self._seq] = item
+            self._enqueue(priority, self._seq, item)
+        if job is not None:
+            job.futures.append(future)
+        return future
+
+    def send_message(self, bot, chat_id, text, priority=PRIORITY_INTERACTIVE, job=None, **kwargs):
+        """排入一則 send_message，回傳可 await 的 Future (結果為 Message)。"""
+        call = functools.partial(bot.send_message, chat_id=chat_id, text=text, **kwargs)
+        return self.submit(chat_id, call, priority=priority, job=job)
+
+    def reply(self, message, text, **kwargs):
+        """以 message.reply_text 回覆使用者 (互動優先)，回傳可 await 的 Future。"""
+        return self.submit(message.chat_id, functools.partial(message.reply_text, text, **kwargs))
+
+    def edit(self, query, text, **kwargs):
+        """修改 callback query 所屬的訊息 (互動優先)，回傳可 await 的 Future。"""
+        return self.submit(query.message.chat_id, functools.partial(query.edit_message_text, text, **kwargs))
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, seq, item = await self._queue.get()
+            if item["future"].done():
+                self._unsettled.pop(seq, None)     # 呼叫端已取消
+                continue
+
+            # 單一聊天室限流：尚無 token 就延後重新排入，不佔用 worker
+            wait = self._chat_bucket(item["chat_id"]).try_acquire()
+            if wait > 0:
+                loop.call_later(wait, self._enqueue, priority, seq, item)
+                continue
+
+            # 全域限流與 RetryAfter 暫停
+            while True:
+                pause = self._paused_until - time_mod.monotonic()
+                wait = pause if pause > 0 else self.global_bucket.try_acquire()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            try:
+                result = await item["call"]()
+                self._settle(item, result=result)
+            except RetryAfter as e:
+                self._paused_until = time_mod.monotonic() + float(e.retry_after)
+                self._retry(item, priority, seq, float(e.retry_after), e)
+            except (BadRequest, Forbidden) as e:
+                self._settle(item, error=e)     # 不可重試的錯誤
+            except NetworkError as e:
+                self._retry(item, priority, seq, min(2 ** item["attempt"], 30), e)
+            except Exception as e:
+                self._settle(item, error=e)
+
+    def _retry(self, item, priority, seq, delay, error):
+        item["attempt"] += 1
+        if item["attempt"] > self.max_retries:
+            self._settle(item, error=error)
+            return
+        print(f"[Send Warning] Retrying message to {item['chat_id']} in {delay:.1f}s: {error}")
+        asyncio.get_running_loop().call_later(delay, self._enqueue, priority, seq, item)
+
+    def _settle(self, item, result=None, error=None, cancelled=False):
+        self._unsettled.pop(item["seq"], None)
+        job = item["job"]
+        if cancelled:
+            if job is not None:
+                job.failed += 1
+            item["future"].cancel()
+        elif error is not None:
+            if job is not None:
+                job.failed += 1
+            if not item["future"].done():
+                item["future"].set_exception(error)
+        else:
+            if job is not None:
+                job.sent += 1
+            if not item["future"].done():
+                item["future"].set_result(result)
+
+    def start_job(self, name):
+        return BroadcastJob(name)
+
+    async def wait_job(self, job):
+        """等待廣播工作的所有訊息完成並回報耗時。"""
+        await asyncio.gather(*job.futures, return_exceptions=True)
+        job.duration = time_mod.monotonic() - job.started
+        self.last_jobs[job.name] = job
+        print(f"[Job] {job.name}: {job.sent} sent, {job.failed} failed in {job.duration:.2f}s")
+        return job
+
+
+outbound = OutboundScheduler(
+    SEND_CONCURRENCY, SEND_GLOBAL_RATE, SEND_PRIVATE_CHAT_RATE, SEND_GROUP_CHAT_RATE, SEND_MAX_RETRIES
+)
 
 
 # ==== Telegram /start 指令 ====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user or not user.username:
-        await update.message.reply_text("⚠️ 請先在 Telegram 設定您的 @username。")
+        await outbound.reply(update.message, "⚠️ 請先在 Telegram 設定您的 @username。")
         return
 
     uname = user.username.lower()
     if uname not in users:
-        await update.message.reply_text(f"⚠️ @{user.username} 未被授權使用此機器人，請聯繫管理員。")
+        await outbound.reply(update.message, f"⚠️ @{user.username} 未被授權使用此機器人，請聯繫管理員。")
         return
 
     # 若 user_id 尚未寫入，就寫一次回 CSV
-    if users[uname].get("user_id") != user.id:
-        users[uname]["user_id"] = user.id
-        save_users_to_csv()
+    if users[uname].user_id != user.id:
+        users.set_user_id(uname, user.id)
+        save_users()
 
     keyboard = [["🟢 上班打卡", "🔴 下班打卡"], ["📝 申請休假"]]
     markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
-    await update.message.reply_text(f"你好，{users[uname]['name']}！請選擇操作：", reply_markup=markup)
+    await outbound.reply(update.message, f"你好，{users[uname].name}！請選擇操作：", reply_markup=markup)
 
 
 # ==== 定時工作 ====
+@timed(JOB_SECONDS, JOB_ERRORS, job="daily_status_reset")
 async def reset_daily_status(context: ContextTypes.DEFAULT_TYPE):
     """每日凌晨重置所有使用者的打卡狀態"""
-    for uname in users:
-        users[uname]["checkin_full"] = None
-        users[uname]["checkout_full"] = None
+    users.reset_day()
+    today_board.reset(datetime.now().strftime("%Y-%m-%d"))
     print("[Job] Daily user status has been reset.")
+    await write_state_snapshot()
+
+@timed(JOB_SECONDS, JOB_ERRORS, job="state_snapshot")
+async def state_snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    """定期寫入狀態快照。"""
+    await write_state_snapshot()
+
+@timed(JOB_SECONDS, JOB_ERRORS, job="metrics_refresh")
+async def refresh_metrics_job(context: ContextTypes.DEFAULT_TYPE):
+    """更新需要讀取共享狀態的指標 (Flask 執行緒輸出 /metrics 時只讀快取值)。"""
+    PENDING_LEAVE.set(len(pending_leave))
+
+@timed(JOB_SECONDS, JOB_ERRORS, job="geocode_cache_save")
+async def save_geocode_cache_job(context: ContextTypes.DEFAULT_TYPE):
+    """定期把地理編碼快取寫回磁碟。"""
+    geocode_cache.save()
+    print(f"[Job] Geocode cache stats: {geocode_cache.stats()}")
+
+@timed(JOB_SECONDS, JOB_ERRORS, job="holiday_calendar_refresh")
+async def refresh_holiday_calendar(context: ContextTypes.DEFAULT_TYPE):
+    """背景更新今年 (以及 12 月時的明年) 假日行事曆；離線模式下不連網。"""
+    if HOLIDAY_SOURCE_FILE:
+        return
+    today = datetime.now().date()
+    years = [today.year] + ([today.year + 1] if today.month == 12 else [])
+    loop = asyncio.get_running_loop()
+    for year in years:
+        await loop.run_in_executor(None, holiday_calendar.fetch_year, year)
+
+def _warm_gps_page():
+    """從本機走一次 GPS 頁面路由 (阻塞，請在 executor 中執行)，讓 Flask/Werkzeug 第一次請求的初始化提早發生。"""
+    try:
+        res = requests.get(f"http://127.0.0.1:{FLASK_PORT}/gps/app/{GPS_PAGE_VERSION}",
+                           headers={"Accept-Encoding": "gzip"}, timeout=5)
+        return res.status_code == 200
+    except requests.RequestException as e:
+        print(f"[Warning] GPS page warm-up failed: {e}")
+        return False
+
+@timed(JOB_SECONDS, JOB_ERRORS, job="pre_rush_warmup")
+async def pre_rush_warmup(context: ContextTypes.DEFAULT_TYPE):
+    """上班尖峰前預熱：假日表、地點地址、Bot API 連線、GPS 頁面，讓第一批打卡不必付冷啟動成本。"""
+    started = time_mod.perf_counter()
+    loop = asyncio.get_running_loop()
+    loaded = {}
 
+    # 1. 假日表：今年尚未載入就先下載，並先查一次今天
+    today = datetime.now().date()
+    if not holiday_calendar.has_year(today.year) and not HOLIDAY_SOURCE_FILE:
+        await loop.run_in_executor(None, holiday_calendar.fetch_year, today.year)
+    loaded["holiday_calendar"] = int(holiday_calendar.is_holiday(today) is not None)
+
+    # 2. 地點與使用者登記座標的地址：查詢並釘住 (同一格只查一次)
+    points = {}
+    for lat, lon in zip(site_registry.lats, site_registry.lons):
+        points.setdefault(geocode_cache.cell_key(lat, lon), (lat, lon))
+    for record in users.values():
+        if record.lat or record.lon:
+            points.setdefault(geocode_cache.cell_key(record.lat, record.lon), (record.lat, record.lon))
+    results = await asyncio.gather(*(geocode_cache.pin(lat, lon) for lat, lon in points.values()),
+                                   return_exceptions=True)
+    loaded["geocode_pinned"] = sum(1 for r in results if r is True)
+
+    # 3. Bot API：並行幾個 getMe，預先建立連線池中的 TLS 連線
+    results = await asyncio.gather(*(context.bot.get_me() for _ in range(WARMUP_CONNECTIONS)),
+                                   return_exceptions=True)
+    loaded["bot_connections"] = sum(1 for r in results if not isinstance(r, Exception))
+
+    # 4. GPS 頁面 (頁面內容已在啟動時預先壓縮，這裡暖的是 Flask 路由與連線)
+    loaded["gps_page"] = int(await loop.run_in_executor(None, _warm_gps_page))
+
+    elapsed = time_mod.perf_counter() - started
+    for kind, count in loaded.items():
+        WARMUP_ITEMS.set(count, kind=kind)
+    WARMUP_LAST_SECONDS.set(elapsed)
+    print(f"[Job] Pre-rush warm-up finished in {elapsed:.2f}s: {loaded}")
+
+@timed(JOB_SECONDS, JOB_ERRORS, job="storage_checkpoint")
+async def storage_checkpoint_job(context: ContextTypes.DEFAULT_TYPE):
+    """定期保存儲存層的輔助結構 (CSV 日期索引 / SQLite WAL checkpoint)。"""
+    await storage.checkpoint()
+
+def _log_send_failure(tag, message):
+    """產生 Future 完成回呼：排程送出失敗時印出錯誤。"""
+    def callback(future):
+        if not future.cancelled() and future.exception():
+            print(f"[{tag}] {message}: {future.exception()}")
+    return callback
+
+@timed(JOB_SECONDS, JOB_ERRORS, job="late_checkout_reminder")
 async def send_late_checkout_reminder(context: ContextTypes.DEFAULT_TYPE):
     today = datetime.now().date()
-    for uname, udata in users.items():
-        if udata.get("role") not in ["employee", "supervisor"]:
+    job = outbound.start_job("late_checkout_reminder")
+    # 只看「已上班未下班」索引，不掃全部使用者
+    for record in users.checked_in_not_out():
+        if record.role not in ["employee", "supervisor"]:
             continue
-        emp_id = udata.get("user_id")
+        emp_id = record.user_id
         if not emp_id:
             continue
 
         # FIX: 使用 checkin_full 和 checkout_full 進行判斷
-        if udata.get("checkin_full") and not udata.get("checkout_full"):
-            if udata["checkin_full"].date() == today:
-                try:
-                    await context.bot.send_message(chat_id=emp_id, text="🕒 提醒：您今天似乎還沒下班打卡喔！請記得打卡。😊")
-                except Exception as e:
-                    print(f"[Reminder Error] Failed to send reminder to {uname}: {e}")
+        if record.checkin_full.date() == today:
+            future = outbound.send_message(context.bot, emp_id, "🕒 提醒：您今天似乎還沒下班打卡喔！請記得打卡。😊",
+                                           priority=PRIORITY_BROADCAST, job=job)
+            future.add_done_callback(_log_send_failure("Reminder Error", f"Failed to send reminder to {record.username}"))
+    await outbound.wait_job(job)
 
+@timed(JOB_SECONDS, JOB_ERRORS, job="overnight_checkout_check")
 async def check_overnight_checkout_and_notify(context: ContextTypes.DEFAULT_TYPE):
     yesterday = (datetime.now() - timedelta(days=1)).date()
-    for uname, udata in users.items():
-        if udata.get("role") not in ["employee", "supervisor"]:
+    job = outbound.start_job("overnight_checkout_check")
+    for record in users.checked_in_not_out():
+        if record.role not in ["employee", "supervisor"]:
             continue
-        emp_id = udata.get("user_id")
+        uname, emp_id = record.username, record.user_id
         if not emp_id:
             continue
 
-        if udata.get("checkin_full") and udata["checkin_full"].date() == yesterday and not udata.get("checkout_full"):
+        if record.checkin_full.date() == yesterday:
             text_emp = f"⚠️ 您昨日 ({yesterday.strftime('%Y-%m-%d')}) 似乎忘記下班打卡。請盡快聯繫您的直屬主管說明情況。😔"
-            text_grp = f"📢 通知：員工 {udata.get('name')} (@{uname}) 昨日 ({yesterday.strftime('%Y-%m-%d')}) 未下班打卡。請群組處理。"
-            try:
-                await context.bot.send_message(chat_id=emp_id, text=text_emp)
-                await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=text_grp)
-            except Exception as e:
-                print(f"[Overnight Check Error] Failed to send notification for {uname}: {e}")
+            text_grp = f"📢 通知：員工 {record.name} (@{uname}) 昨日 ({yesterday.strftime('%Y-%m-%d')}) 未下班打卡。請群組處理。"
+            for chat_id, text in ((emp_id, text_emp), (GROUP_CHAT_ID, text_grp)):
+                future = outbound.send_message(context.bot, chat_id, text, priority=PRIORITY_BROADCAST, job=job)
+                future.add_done_callback(_log_send_failure("Overnight Check Error", f"Failed to send notification for {uname}"))
+    await outbound.wait_job(job)
+
+_background_tasks = set()   # 背景 task 的強參照：event loop 只保留弱參照，沒有參照的 task 可能還沒跑完就被回收
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 # ==== 處理打卡按鈕 ====
+@timed(HANDLER_SECONDS, HANDLER_ERRORS, handler="handle_button")
+@tracer.traced("checkin")
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user or not user.username:
-        await update.message.reply_text("⚠️ 您的帳號未被授權或尚未設定 @username。")
+        await outbound.reply(update.message, "⚠️ 您的帳號未被授權或尚未設定 @username。")
         return
 
     uname = user.username.lower()
     if uname not in users:
-        await update.message.reply_text("⚠️ 您尚未在系統中註冊，請聯絡管理員。")
+        await outbound.reply(update.message, "⚠️ 您尚未在系統中註冊，請聯絡管理員。")
         return
 
-    # --- 假日檢查 ---
-    today = datetime.now()
-    holiday_url = f"https://api.pin-yi.me/taiwan-calendar/{today.year}/{today.month}/{today.day}"
-    try:
-        res = requests.get(holiday_url, timeout=5)
-        res.raise_for_status()
-        data = res.json()
-        entry = data[0] if isinstance(data, list) and data else data
-        if entry.get("isHoliday"):
-            await update.message.reply_text("❌ 今天是假日，無需打卡。")
-            #return # FIX: 嚴格執行，假日直接返回
-    except requests.RequestException as e:
-        print(f"[Warning] Holiday API call failed: {e}. Proceeding with clock-in.")
+    # --- 假日檢查 (查預先下載的行事曆，不在熱路徑上打 API) ---
+    with tracer.span("holiday_check"):
+        is_holiday = holiday_calendar.is_holiday(datetime.now().date())
+    if is_holiday:
+        await outbound.reply(update.message, "❌ 今天是假日，無需打卡。")
+        #return # FIX: 嚴格執行，假日直接返回
 
     action = update.message.text.strip()
     profile = users[uname]
 
     if "上班" in action:
-        if profile.get("checkin_full"):
-            await update.message.reply_text("❌ 您今天已經完成「上班打卡」，不可重複操作。")
+        if profile.checkin_full:
+            await outbound.reply(update.message, "❌ 您今天已經完成「上班打卡」，不可重複操作。")
             return
 
 
     elif "下班" in action:
-        if not profile.get("checkin_full"):
-            await update.message.reply_text("❌ 您尚未完成「上班打卡」，無法執行下班打卡。")
+        if not profile.checkin_full:
+            await outbound.reply(update.message, "❌ 您尚未完成「上班打卡」，無法執行下班打卡。")
             return
-        if profile.get("checkout_full"):
-            await update.message.reply_text("❌ 您今天已經完成「下班打卡」，不可重複操作。")
+        if profile.checkout_full:
+            await outbound.reply(update.message, "❌ 您今天已經完成「下班打卡」，不可重複操作。")
             return
 
-    session_id = ''.join(random.choices(string.ascii_letters + string.digits, k=20))
     check_type = "in" if "上班" in action else "out"
-    active_session[session_id] = {"uname": uname, "type": check_type, "chat_id": update.effective_chat.id}
+    # 先登記 session 再送出連結，避免使用者極快回傳時找不到等待者
+    with tracer.span("create_session"):
+        try:
+            session, created = await gps_store.open(uname, check_type, update.effective_chat.id)
+        except sqlite3.Error as e:
+            print(f"[State Error] Failed to create GPS session for {uname}: {e}")
+            await outbound.reply(update.message, "⚠️ 系統忙碌中，請稍後再試一次。")
+            return
 
-    url = f"{WEBHOOK_URL}/gps/{session_id}"
-    await update.message.reply_text(
-        f"📛 員工姓名：{users[uname]['name']}\n"
-        f"請點擊以下連結授權 GPS 定位：\n{url}\n\n"
-        f"📍 成功後將自動回報打卡。"
-    )
+    url = gps_page_url(session.sid)
+    if not created:
+        # 重複點按：沿用進行中的 session 與連結，不再另開等待 task
+        GPS_SESSION_REUSES.inc()
+        if session.submitted:
+            await outbound.reply(update.message, "⏳ 已收到您的定位，正在處理打卡，請稍候。")
+        else:
+            remaining = max(1, int(session.expires_at - time_mod.monotonic()))
+            await outbound.reply(update.message,
+                f"⏳ 您已有進行中的打卡，請使用以下連結 (約 {remaining} 秒內有效)：\n{url}"
+            )
+        return
+
+    with tracer.span("reply_link"):
+        await outbound.reply(update.message,
+            f"📛 員工姓名：{profile.name}\n"
+            f"請點擊以下連結授權 GPS 定位：\n{url}\n\n"
+            f"📍 成功後將自動回報打卡。"
+        )
 
     async def wait_for_gps_then_report():
-        for _ in range(60): # 等待 60 秒
-            if gps_sessions.get(session_id, {}).get("done"):
-                session_data = gps_sessions.pop(session_id)
-                await report_checkin(uname, session_data, check_type, context)
-                active_session.pop(session_id, None)
-                return
-            await asyncio.sleep(1)
+        # 逾時由 gps_store 的過期機制處理 (以 None 完成)
+        with tracer.span("gps_wait"):
+            session_data = await session.future
+        gps_store.discard(session.sid)
+        if session_data is None:
+            try:
+                await outbound.send_message(context.bot, session.chat_id, "⏰ 定位逾時，請重新嘗試打卡。")
+            except Exception as e:
+                print(f"[Report Error] Failed to send GPS timeout notice for {uname}: {e}")
+            return
 
-        orig_chat_id = active_session.pop(session_id, {}).get("chat_id")
-        if orig_chat_id:
-            await context.bot.send_message(chat_id=orig_chat_id, text="⏰ 定位逾時，請重新嘗試打卡。")
-        gps_sessions.pop(session_id, None)
+        await report_checkin(uname, session_data, check_type, context, chat_id=session.chat_id)
 
-    asyncio.create_task(wait_for_gps_then_report())
+    spawn_background(wait_for_gps_then_report())
 
 
-async def report_checkin(uname, session_details, mode, context: ContextTypes.DEFAULT_TYPE):
-    """當收到 GPS 後，執行實際的打卡報告與檔案寫入。"""
+@timed(HANDLER_SECONDS, HANDLER_ERRORS, handler="report_checkin")
+async def report_checkin(uname, session_details, mode, context: ContextTypes.DEFAULT_TYPE, chat_id=None):
+    """當收到 GPS 後，執行實際的打卡報告與檔案寫入。chat_id 為發起打卡的聊天室 (GPS session 的 chat_id)。"""
     user_profile = users[uname]
     lat, lon = session_details["lat"], session_details["lon"]
     now = session_details["timestamp"]
     now_str = now.strftime("%Y-%m-%d %H:%M:%S")
 
-    dist = int(haversine(lat, lon, user_profile["lat"], user_profile["lon"]))
-    actual_addr = get_address(lat, lon)
+    # 冪等：等待 GPS 期間可能已由另一個 session 完成同一種打卡，不重複寫入紀錄
+    done_at = user_profile.checkin_full if mode == "in" else user_profile.checkout_full
+    if done_at and done_at.date() == now.date():
+        label = "上班打卡" if mode == "in" else "下班打卡"
+        reply_to = chat_id or user_profile.user_id
+        if reply_to:
+            try:
+                await outbound.send_message(context.bot, reply_to,
+                                            f"❌ 您今天已經完成「{label}」({done_at.strftime('%H:%M:%S')})，此次定位不重複記錄。")
+            except Exception as e:
+                print(f"[Report Error] Failed to send duplicate check-in notice for {uname}: {e}")
+        return
+
+    with tracer.span("site_locate"):
+        fence = site_registry.locate(uname, user_profile, lat, lon)
+    dist = int(fence["distance"])
+    # 兩階段：快取有地址就直接用，否則先以「查詢中」回報，地址稍後補上
+    actual_addr = geocode_cache.peek(lat, lon)
 
     t_now = now.time()
     t_start = time.fromisoformat(WORK_HOURS["start"])
@@ -673,25 +3306,25 @@ async def report_checkin(uname, session_details, mode, context: ContextTypes.DEF
 
     msg_lines = [
         f"✅ 打卡成功！",
-        f"👤 使用者：@{uname} ({user_profile['name']})",
-        f"📍 打卡位置：{actual_addr}",
-        f"📏 與登記距離差距：約 {dist} 公尺",
+        f"👤 使用者：@{uname} ({user_profile.name})",
+        f"📍 打卡位置：{actual_addr or ADDRESS_PENDING_TEXT}",
+        f"📏 最近打卡地點：{fence['name']}，距離約 {dist} 公尺" + ("" if fence["inside"] else " ⚠️ 不在允許範圍內"),
         f"🕒 打卡時間：{now_str}"
     ]
 
     status = ""
     if mode == "in":
-        user_profile["checkin_full"] = now
+        users.set_checkin(uname, now)
         status = "✔️ 正常上班" if t_now <= t_start else f"❗遲到 (應於 {WORK_HOURS['start']})"
         msg_lines.append(f"☑️ 上班狀態：{status}")
         forwarding_users[uname] = True
     else: # mode == "out"
-        user_profile["checkout_full"] = now
+        users.set_checkout(uname, now)
         status = "✔️ 正常下班" if t_now >= t_end else f"❗早退 (應於 {WORK_HOURS['end']})"
         msg_lines.append(f"☑️ 下班狀態：{status}")
 
-        if user_profile.get("checkin_full"):
-            checkin_time = user_profile["checkin_full"].time()
+        if user_profile.checkin_full:
+            checkin_time = user_profile.checkin_full.time()
             is_late = checkin_time > t_start
             is_early_leave = t_now < t_end
 
@@ -701,34 +3334,93 @@ async def report_checkin(uname, session_details, mode, context: ContextTypes.DEF
             elif is_early_leave: summary = "⚠️ 正常上班但早退"
 
             msg_lines.append(f"📉 本日統計：{summary}")
-            msg_lines.append(f"🕘 上班：{user_profile['checkin_full'].strftime('%H:%M:%S')}")
+            msg_lines.append(f"🕘 上班：{user_profile.checkin_full.strftime('%H:%M:%S')}")
             msg_lines.append(f"🕕 下班：{now.strftime('%H:%M:%S')}")
         else:
             msg_lines.append("⚠️ 今日無上班打卡記錄")
 
         forwarding_users.pop(uname, None)
 
-    final_msg = "\n".join(msg_lines)
+    # 先寫入出勤紀錄 (CSV 引擎僅排入背景寫入器)，並更新今日看板
+    attendance_row = {
+        "username": uname, "name": user_profile.name, "date": now.strftime("%Y-%m-%d"),
+        "type": mode, "timestamp": now_str, "address": actual_addr or pending_address(lat, lon),
+        "distance_m": dist, "status": status, "site": fence["site_id"], "in_fence": int(fence["inside"])
+    }
+    with tracer.span("attendance_append"):
+        storage.append_attendance(attendance_row)
+        today_board.record_row(attendance_row)
 
+    final_msg = "\n".join(msg_lines)
+    message = None
     try:
         #if GROUP_CHAT_ID:
             #await context.bot.send_message(chat_id=GROUP_CHAT_ID, text=f"【打卡通知】\n{final_msg}")
-        if user_profile.get("user_id"):
-            await context.bot.send_message(chat_id=user_profile["user_id"], text=final_msg)
+        if user_profile.user_id:
+            with tracer.span("send_confirmation"):
+                message = await outbound.send_message(context.bot, user_profile.user_id, final_msg)
     except Exception as e:
         print(f"[Report Error] Failed to send check-in message for {uname}: {e}")
 
-    # 寫入 attendance_log.csv
-    ensure_attendance_csv()
+    if actual_addr is None:
+        spawn_background(enrich_checkin_address(attendance_row, message, msg_lines, lat, lon, context.bot))
+
+
+def pending_address(lat, lon):
+    """尚未查到地址時寫入出勤紀錄的值：保留座標，程序重啟後仍能補查。"""
+    return f"{ADDRESS_PENDING_TEXT} ({lat:.6f},{lon:.6f})"
+
+def parse_pending_address(value):
+    """從待查地址取回 (lat, lon)；不是待查地址或沒有座標時回傳 None。"""
+    if not value or not value.startswith(ADDRESS_PENDING_TEXT):
+        return None
     try:
-        with open(ATTENDANCE_CSV, "a", encoding="utf-8", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                uname, user_profile["name"], now.strftime("%Y-%m-%d"),
-                mode, now_str, actual_addr, dist, status
-            ])
+        lat, lon = value[len(ADDRESS_PENDING_TEXT):].strip(" ()").split(",")
+        return float(lat), float(lon)
+    except ValueError:
+        return None
+
+async def requeue_pending_addresses():
+    """啟動時補查今日仍為「查詢中」的出勤紀錄 (上次程序在查到地址前就結束)。"""
+    today = datetime.now().strftime("%Y-%m-%d")
+    try:
+        rows = await storage.query_attendance(today, today)
+    except Exception as e:
+        print(f"[Error] Failed to scan attendance rows for pending addresses: {e}")
+        return
+    pending = [(row, parse_pending_address(row.get("address"))) for row in rows]
+    pending = [(row, coords) for row, coords in pending if coords]
+    for row, (lat, lon) in pending:
+        spawn_background(enrich_checkin_address(row, None, None, lat, lon, None))
+    if pending:
+        print(f"[Info] Re-queued address lookup for {len(pending)} attendance rows.")
+
+async def enrich_checkin_address(attendance_row, message, msg_lines, lat, lon, bot):
+    """打卡第二階段：查到地址後補註出勤紀錄，並把確認訊息中的「查詢中」改成實際地址 (message 為 None 時只補註紀錄)。"""
+    uname = attendance_row["username"]
+    try:
+        with tracer.span("geocode"):
+            address = await geocode_cache.lookup(lat, lon)
+    except Exception as e:
+        print(f"[Report Error] Address lookup failed for {uname}: {e}")
+        address = "無法取得地址 (請求失敗)"
+
+    try:
+        with tracer.span("attendance_annotate"):
+            await storage.annotate_attendance(attendance_row, {"address": address})
     except Exception as e:
-        print(f"[CSV Error] Failed to write to attendance_log.csv: {e}")
+        print(f"[Report Error] Failed to annotate attendance row for {uname}: {e}")
+
+    if message is None:
+        return
+    pending_line = f"📍 打卡位置：{ADDRESS_PENDING_TEXT}"
+    text = "\n".join(f"📍 打卡位置：{address}" if line == pending_line else line for line in msg_lines)
+    try:
+        with tracer.span("edit_confirmation"):
+            await outbound.submit(message.chat_id, functools.partial(
+                bot.edit_message_text, chat_id=message.chat_id, message_id=message.message_id, text=text))
+    except Exception as e:
+        print(f"[Report Error] Failed to update check-in message for {uname}: {e}")
 
 
 # ==== 處理員工筆記轉發 ====
@@ -740,14 +3432,15 @@ async def handle_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 只有在 forwarding_users 列表中的使用者才轉發
     if uname in forwarding_users and GROUP_CHAT_ID:
         try:
-            await context.bot.forward_message(
+            await outbound.submit(GROUP_CHAT_ID, functools.partial(
+                context.bot.forward_message,
                 chat_id=GROUP_CHAT_ID,
                 from_chat_id=update.message.chat_id,
                 message_id=update.message.message_id
-            )
-            await context.bot.send_message(
-                chat_id=GROUP_CHAT_ID,
-                text=f"✉️ 來自 {users[uname]['name']} 的筆記"
+            ))
+            await outbound.send_message(
+                context.bot, chat_id=GROUP_CHAT_ID,
+                text=f"✉️ 來自 {users[uname].name} 的筆記"
             )
         except Exception as e:
             print(f"[Forward Error] Failed to forward note from {uname}: {e}")
@@ -757,24 +3450,26 @@ async def handle_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_leave_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user or not user.username:
-        await update.message.reply_text("⚠️ 請先在 Telegram 設定您的 @username。")
+        await outbound.reply(update.message, "⚠️ 請先在 Telegram 設定您的 @username。")
         return
 
     uname = user.username.lower()
     if uname not in users:
-        await update.message.reply_text("⚠️ 您尚未註冊。")
+        await outbound.reply(update.message, "⚠️ 您尚未註冊。")
         return
 
     if context.user_data.get("await_leave_reason"):
-        await update.message.reply_text("您已有一則請假申請正在處理中。")
+        await outbound.reply(update.message, "您已有一則請假申請正在處理中。")
         return
 
-    await update.message.reply_text(
+    await outbound.reply(update.message,
         "📝 請輸入請假原因 (例如：事假，2025/06/10 全天)。\n"
         "您稍後可以補充附件(照片/檔案)。"
     )
     context.user_data["await_leave_reason"] = True
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS, handler="handle_leave_text")
+@tracer.traced("leave_request")
 async def handle_leave_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.user_data.get("await_leave_reason"): return
     if not update.message or not update.message.text or update.message.text.startswith("/"): return
@@ -786,24 +3481,19 @@ async def handle_leave_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     leave_request_id = f"leave_{uname}_{int(datetime.now().timestamp())}"
     pending_leave[leave_request_id] = {
-        "employee_uname": uname, "employee_name": users[uname]["name"],
+        "employee_uname": uname, "employee_name": users[uname].name,
         "employee_user_id": user.id, "reason": leave_reason,
         "attachments": [], "group_message_id": None, "status": "pending"
     }
     context.user_data["current_leave_request_id"] = leave_request_id
 
-    # 寫入 CSV
-    ensure_leave_csv()
-    try:
-        with open(LEAVE_CSV, "a", encoding="utf-8", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                leave_request_id, uname, users[uname]["name"], leave_reason,
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "pending",
-                "", "", "", ""
-            ])
-    except Exception as e:
-        print(f"[CSV Error] Failed to write initial leave request: {e}")
+    # 寫入請假紀錄
+    with tracer.span("storage_append"):
+        storage.append_leave({
+            "request_id": leave_request_id, "username": uname, "name": users[uname].name,
+            "reason": leave_reason, "request_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "status": "pending"
+        })
 
     keyboard = [[
         InlineKeyboardButton("✅ 同意", callback_data=f"approve_{leave_request_id}"),
@@ -813,20 +3503,24 @@ async def handle_leave_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if GROUP_CHAT_ID:
         try:
-            group_msg = await context.bot.send_message(
-                chat_id=GROUP_CHAT_ID,
-                text=(
-                    f"📢 休假申請通知 📢\n\n"
-                    f"👤 員工：{users[uname]['name']} (@{uname})\n"
-                    f"📝 事由：{leave_reason}\n\n"
-                    f"請審核："
-                ),
-                reply_markup=markup
-            )
-            pending_leave[leave_request_id]["group_message_id"] = group_msg.message_id
-            await update.message.reply_text("✅ 您的請假申請已送出，等待審核。若需補充證明，請直接傳送照片或檔案。")
+            with tracer.span("group_notify"):
+                group_msg = await outbound.send_message(
+                    context.bot, chat_id=GROUP_CHAT_ID,
+                    text=(
+                        f"📢 休假申請通知 📢\n\n"
+                        f"👤 員工：{users[uname].name} (@{uname})\n"
+                        f"📝 事由：{leave_reason}\n\n"
+                        f"請審核："
+                    ),
+                    reply_markup=markup
+                )
+            # 共用後端取出的是複本，改完要寫回
+            leave_info = pending_leave[leave_request_id]
+            leave_info["group_message_id"] = group_msg.message_id
+            pending_leave[leave_request_id] = leave_info
+            await outbound.reply(update.message, "✅ 您的請假申請已送出，等待審核。若需補充證明，請直接傳送照片或檔案。")
         except Exception as e:
-            await update.message.reply_text("⚠️ 您的請假申請無法送出，請聯絡管理員。")
+            await outbound.reply(update.message, "⚠️ 您的請假申請無法送出，請聯絡管理員。")
             print(f"[Leave Error] Failed to send leave request to group: {e}")
             pending_leave.pop(leave_request_id, None)
             context.user_data.pop("current_leave_request_id", None)
@@ -846,81 +3540,67 @@ async def handle_attachments(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     if not file_id: return
 
+    storage.add_leave_attachment(leave_request_id, file_id)
+
     # 轉發附件到群組
     leave_info = pending_leave[leave_request_id]
     caption = f"📎 附件更新：來自 {leave_info['employee_name']} 的請假申請 (事由: {leave_info['reason'][:30]}...)"
     try:
         if attach_type == "照片":
-            await context.bot.send_photo(chat_id=GROUP_CHAT_ID, photo=file_id, caption=caption)
+            send = functools.partial(context.bot.send_photo, chat_id=GROUP_CHAT_ID, photo=file_id, caption=caption)
         else:
-            await context.bot.send_document(chat_id=GROUP_CHAT_ID, document=file_id, caption=caption)
-        await update.message.reply_text(f"📎 {attach_type}附件已補充給審核群組。")
+            send = functools.partial(context.bot.send_document, chat_id=GROUP_CHAT_ID, document=file_id, caption=caption)
+        await outbound.submit(GROUP_CHAT_ID, send)
+        await outbound.reply(update.message, f"📎 {attach_type}附件已補充給審核群組。")
     except Exception as e:
-        await update.message.reply_text(f"⚠️ 附件無法傳送給群組。")
+        await outbound.reply(update.message, f"⚠️ 附件無法傳送給群組。")
         print(f"[Attachment Error] Failed to forward attachment: {e}")
 
-# FIX: 重構並簡化 CSV 更新邏輯
-def update_leave_csv_record(request_id, updates):
-    """通用函式：讀取、更新、並寫回 leave_requests.csv 的特定紀錄"""
-    try:
-        with open(LEAVE_CSV, "r", encoding="utf-8", newline="") as f:
-            rows = list(csv.reader(f))
-
-        header = rows[0]
-        col_map = {name: i for i, name in enumerate(header)}
-
-        # 找到要更新的行
-        for i, row in enumerate(rows):
-            if i > 0 and row[col_map["request_id"]] == request_id:
-                for key, value in updates.items():
-                    if key in col_map:
-                        row[col_map[key]] = value
-                break
-
-        with open(LEAVE_CSV, "w", encoding="utf-8", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerows(rows)
-        return True
-    except Exception as e:
-        print(f"[CSV Error] Failed to update leave record {request_id}: {e}")
-        return False
-
-
+@timed(HANDLER_SECONDS, HANDLER_ERRORS, handler="handle_approval")
+@tracer.traced("leave_decision")
 async def handle_approval(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
     action, leave_request_id = query.data.split("_", 1)
-    if leave_request_id not in pending_leave:
-        await query.edit_message_text(text="⚠️ 此休假申請已不存在或已被處理。")
+    # 不同主管的按鈕會並行處理：同意時在第一個 await 之前就取走申請，只有一人能處理
+    leave_info = pending_leave.pop(leave_request_id, None) if action == "approve" else pending_leave.get(leave_request_id)
+    if leave_info is None:
+        await outbound.edit(query, "⚠️ 此休假申請已不存在或已被處理。")
         return
 
-    leave_info = pending_leave[leave_request_id]
     approver = query.from_user.username or query.from_user.first_name
 
     if action == "approve":
-        # 1. 通知員工
-        await context.bot.send_message(
-            chat_id=leave_info["employee_user_id"],
-            text=f"✅ 您的請假申請 (事由：{leave_info['reason']}) 已被 @{approver} 同意。"
-        )
+        try:
+            # 1. 通知員工
+            with tracer.span("notify_employee"):
+                await outbound.send_message(
+                    context.bot, chat_id=leave_info["employee_user_id"],
+                    text=f"✅ 您的請假申請 (事由：{leave_info['reason']}) 已被 @{approver} 同意。"
+                )
+        except Exception:
+            pending_leave[leave_request_id] = leave_info    # 員工尚未收到通知：放回待審，可再按一次
+            raise
         # 2. 編輯群組訊息
-        await query.edit_message_text(
-            text=f"✅ 已同意 {leave_info['employee_name']} 的休假申請。\n事由：{leave_info['reason']}\n(由 @{approver} 處理)",
-            reply_markup=None
-        )
+        with tracer.span("edit_group_message"):
+            await outbound.edit(query,
+                text=f"✅ 已同意 {leave_info['employee_name']} 的休假申請。\n事由：{leave_info['reason']}\n(由 @{approver} 處理)",
+                reply_markup=None
+            )
         # 3. 更新 CSV
         updates = {"status": "approved", "approver": approver, "decision_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-        update_leave_csv_record(leave_request_id, updates)
-        # 4. 清理
-        pending_leave.pop(leave_request_id, None)
+        with tracer.span("storage_update"):
+            await storage.update_leave(leave_request_id, updates)
 
     elif action == "deny":
         context.user_data["denying_leave_request_id"] = leave_request_id
-        prompt = await query.message.reply_text(f"📝 請回覆此訊息以輸入否決 {leave_info['employee_name']} 休假申請的原因。")
+        prompt = await outbound.reply(query.message, f"📝 請回覆此訊息以輸入否決 {leave_info['employee_name']} 休假申請的原因。")
         context.user_data["deny_reason_prompt_id"] = prompt.message_id
         context.user_data["denier_username"] = approver
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS, handler="handle_deny_reason")
+@tracer.traced("leave_deny")
 async def handle_deny_reason(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.user_data.get("denying_leave_request_id"): return
 
@@ -928,37 +3608,45 @@ async def handle_deny_reason(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not (update.message.reply_to_message and update.message.reply_to_message.message_id == prompt_id): return
 
     leave_request_id = context.user_data["denying_leave_request_id"]
-    leave_info = pending_leave.get(leave_request_id)
+    # 在第一個 await 之前取走申請，避免與其他主管的同意/否決同時處理
+    leave_info = pending_leave.pop(leave_request_id, None)
     if not leave_info:
-        await update.message.reply_text("⚠️ 原休假申請已不存在。")
+        await outbound.reply(update.message, "⚠️ 原休假申請已不存在。")
         return
 
     deny_reason = update.message.text
     denier = context.user_data["denier_username"]
 
     # 1. 通知員工
-    await context.bot.send_message(
-        chat_id=leave_info["employee_user_id"],
-        text=f"❌ 您的請假申請 (事由：{leave_info['reason']}) 已被 @{denier} 否決。\n否決原因：{deny_reason}"
-    )
+    try:
+        with tracer.span("notify_employee"):
+            await outbound.send_message(
+                context.bot, chat_id=leave_info["employee_user_id"],
+                text=f"❌ 您的請假申請 (事由：{leave_info['reason']}) 已被 @{denier} 否決。\n否決原因：{deny_reason}"
+            )
+    except Exception:
+        pending_leave[leave_request_id] = leave_info    # 員工尚未收到通知：放回待審
+        raise
     # 2. 編輯群組原始訊息
-    await context.bot.edit_message_text(
-        chat_id=GROUP_CHAT_ID, message_id=leave_info["group_message_id"],
-        text=f"❌ 已否決 {leave_info['employee_name']} 的休假申請。\n事由：{leave_info['reason']}\n否決原因：{deny_reason}\n(由 @{denier} 處理)",
-        reply_markup=None
-    )
+    with tracer.span("edit_group_message"):
+        await outbound.submit(GROUP_CHAT_ID, functools.partial(
+            context.bot.edit_message_text,
+            chat_id=GROUP_CHAT_ID, message_id=leave_info["group_message_id"],
+            text=f"❌ 已否決 {leave_info['employee_name']} 的休假申請。\n事由：{leave_info['reason']}\n否決原因：{deny_reason}\n(由 @{denier} 處理)",
+            reply_markup=None
+        ))
     # 3. 更新 CSV
     updates = {
         "status": "denied", "approver": denier,
         "decision_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "deny_reason": deny_reason
     }
-    update_leave_csv_record(leave_request_id, updates)
+    with tracer.span("storage_update"):
+        await storage.update_leave(leave_request_id, updates)
 
     # 4. 清理
     await update.message.reply_to_message.delete() # 刪除 "請輸入原因" 的提示
-    await update.message.reply_text("否決原因已發送給員工。")
-    pending_leave.pop(leave_request_id, None)
+    await outbound.reply(update.message, "否決原因已發送給員工。")
     for key in ["denying_leave_request_id", "deny_reason_prompt_id", "denier_username"]:
         context.user_data.pop(key, None)
 
@@ -971,132 +3659,311 @@ def escape_markdown(text: str) -> str:
     escape_chars = r'_*[]()~`>#+-=|{}.!'
     return ''.join(f'\\{char}' if char in escape_chars else char for char in text)
 
+class TodayBoard:
+    """今日打卡即時看板：每筆打卡以 O(1) 更新，/todaystat 直接由此產生而不讀磁碟。
+
+    每次更新遞增 version，渲染好的 MarkdownV2 表格依 (version, 目標使用者) 快取到下一次打卡。
+    """
+
+    def __init__(self):
+        self.date = None
+        self.entries = {}       # uname -> 今日彙總
+        self.version = 0
+        self._rendered = {}     # target_uname -> 表格文字 (僅對目前 version 有效)
+
+    def reset(self, date_str):
+        self.date = date_str
+        self.entries = {}
+        self._bump()
+
+    def _bump(self):
+        self.version += 1
+        self._rendered = {}
+
+    def record_row(self, row):
+        """套用一筆出勤紀錄：保留最早的上班與最晚的下班。"""
+        if row["date"] != self.date:
+            if self.date and row["date"] < self.date:
+                return
+            self.reset(row["date"])
+        ts = row["timestamp"].split(" ")[1]
+        entry = self.entries.get(row["username"])
+        if entry is None:
+            entry = self.entries[row["username"]] = {
+                "name": row["name"], "in": "—", "out": "—", "in_status": "", "out_status": "",
+                "in_distance": None, "out_distance": None, "late": False, "early": False
+            }
+        if row["type"] == "in" and (entry["in"] == "—" or ts < entry["in"]):
+            entry.update({"in": ts, "in_status": row.get("status", ""), "in_distance": row.get("distance_m"),
+                          "late": ts > WORK_HOURS["start"] + ":00"})
+        elif row["type"] == "out" and (entry["out"] == "—" or ts > entry["out"]):
+            entry.update({"out": ts, "out_status": row.get("status", ""), "out_distance": row.get("distance_m"),
+                          "early": ts < WORK_HOURS["end"] + ":00"})
+        self._bump()
+
+    def render(self, target_uname=None):
+        """回傳 MarkdownV2 表格；沒有紀錄時回傳 None。"""
+        if target_uname in self._rendered:
+            return self._rendered[target_uname]
+        rows = sorted((u, e) for u, e in self.entries.items() if not target_uname or u == target_uname)
+        text = None
+        if rows:
+            # FIX: Escape the date in the title
+            msg_lines = [f"📅 *{escape_markdown(self.date)} 打卡統計*"]
+            # FIX: Using code blocks (`) for the table content avoids needing to escape most characters inside.
+            msg_lines.append("`使用者          | 上班時間 | 下班時間`")
+            msg_lines.append("`----------------+----------+----------`")
+            for uname_r, info in rows:
+                # Ensure username column has fixed width for alignment
+                user_part = f"@{uname_r:<15}"
+                time_part = f" | {info['in']:<8} | {info['out']:<8}"
+                msg_lines.append(f"`{user_part}{time_part}`")
+            text = "\n".join(msg_lines)
+        self._rendered[target_uname] = text
+        return text
+
+    def to_dict(self):
+        return {"date": self.date, "entries": self.entries}
+
+    def load_dict(self, data):
+        if data.get("date"):
+            self.date = data["date"]
+            self.entries = dict(data.get("entries", {}))
+            self._bump()
+
+
+today_board = TodayBoard()
+
 async def supervisor_command(update: Update, context: ContextTypes.DEFAULT_TYPE, command_func):
     """裝飾器/包裝函式，檢查使用者是否為 supervisor"""
     user = update.effective_user
-    if not user or not user.username:
-        await update.message.reply_text("⚠️ 請先設定您的 @username。")
+    if not user:
         return
-
-    uname = user.username.lower()
-    if users.get(uname, {}).get("role") != "supervisor":
-        await update.message.reply_text("❌ 您沒有權限執行此指令。")
+    if users.by_user_id(user.id) is None:
+        await outbound.reply(update.message, "⚠️ 請先傳送 /start 綁定您的帳號。")
+        return
+    if not users.has_role(user.id, "supervisor"):
+        await outbound.reply(update.message, "❌ 您沒有權限執行此指令。")
         return
 
     await command_func(update, context)
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS, handler="todaystat")
+@tracer.traced("todaystat")
 async def _todaystat_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
     today_str = datetime.now().strftime("%Y-%m-%d")
     target_uname = context.args[0].lower() if context.args else None
 
-    records = []
-    if os.path.exists(ATTENDANCE_CSV):
-        with open(ATTENDANCE_CSV, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row["date"] == today_str:
-                    if not target_uname or row["username"] == target_uname:
-                        records.append(row)
+    if today_board.date != today_str:
+        today_board.reset(today_str)
 
-    if not records:
+    with tracer.span("render"):
+        table = today_board.render(target_uname)
+    if table is None:
         msg = f"❌ {escape_markdown(today_str)} 尚無任何打卡紀錄。"
         if target_uname: msg = f"❌ 找不到使用者 @{escape_markdown(target_uname)} 在 {escape_markdown(today_str)} 的打卡紀錄。"
-        await update.message.reply_text(msg, parse_mode="MarkdownV2")
+        await outbound.reply(update.message, msg, parse_mode="MarkdownV2")
         return
 
-    stat_map = {}
-    for row in records:
-        uname_r = row["username"]
-        if uname_r not in stat_map:
-            stat_map[uname_r] = {"name": row["name"], "in": "—", "out": "—"}
-
-        ts = row["timestamp"].split(" ")[1]
-        if row["type"] == "in": stat_map[uname_r]["in"] = ts
-        elif row["type"] == "out": stat_map[uname_r]["out"] = ts
-
-    # FIX: Escape the date in the title
-    escaped_today = escape_markdown(today_str)
-    msg_lines = [f"📅 *{escaped_today} 打卡統計*"]
-    # FIX: Using code blocks (`) for the table content avoids needing to escape most characters inside.
-    msg_lines.append("`使用者          | 上班時間 | 下班時間`")
-    msg_lines.append("`----------------+----------+----------`")
-    for uname_r, info in sorted(stat_map.items()):
-        # Ensure username column has fixed width for alignment
-        user_part = f"@{uname_r:<15}"
-        time_part = f" | {info['in']:<8} | {info['out']:<8}"
-        msg_lines.append(f"`{user_part}{time_part}`")
-
-    await update.message.reply_text("\n".join(msg_lines), parse_mode="MarkdownV2")
-
-
+    with tracer.span("reply"):
+        await outbound.reply(update.message, table, parse_mode="MarkdownV2")
+
+
+class MonthReport:
+    """一份預先分頁的月報：頁面依使用者邊界切割，每頁不超過 Telegram 訊息長度上限。"""
+
+    def __init__(self, report_id, prefix, target_uname, records):
+        self.report_id = report_id
+        self.prefix = prefix
+        self.target_uname = target_uname
+        self.stat_month = self._aggregate(records)
+        self.pages = self._paginate()
+
+    @staticmethod
+    def _aggregate(records):
+        stat_month = {}
+        for row in records:
+            uname_r, day = row["username"], row["date"].split("-")[2]
+            if uname_r not in stat_month: stat_month[uname_r] = {"name": row["name"], "days": {}}
+            if day not in stat_month[uname_r]["days"]: stat_month[uname_r]["days"][day] = {"in": "—", "out": "—"}
+
+            ts = row["timestamp"].split(" ")[1]
+            if row["type"] == "in": stat_month[uname_r]["days"][day]["in"] = ts
+            elif row["type"] == "out": stat_month[uname_r]["days"][day]["out"] = ts
+        return stat_month
+
+    def _title(self):
+        escaped_prefix = escape_markdown(self.prefix)
+        title_target = f" for `@{escape_markdown(self.target_uname)}`" if self.target_uname else ""
+        return f"📅 *{escaped_prefix} 月度打卡統計*{title_target}"
+
+    def _user_blocks(self):
+        for uname_r, info in sorted(self.stat_month.items()):
+            # FIX: Construct the header line first, then escape the ENTIRE line.
+            # This correctly handles '─', '@', '(', and ')' characters.
+            header_line = f"\n── @{uname_r} ({info['name']}) ──"
+            lines = [escape_markdown(header_line)]
+            for day in sorted(info["days"].keys()):
+                rec = info["days"][day]
+                in_t = escape_markdown(rec["in"])
+                out_t = escape_markdown(rec["out"])
+                lines.append(f"{escape_markdown(day)}日: 上班 {in_t}, 下班 {out_t}")
+            yield "\n".join(lines)
+
+    def _paginate(self):
+        # 預留標題與頁碼的長度
+        budget = TELEGRAM_MESSAGE_LIMIT - len(self._title()) - 64
+        pages, current = [], ""
+        for block in self._user_blocks():
+            # 單一使用者超過一頁時才在行邊界切開
+            while len(block) > budget:
+                cut = block.rfind("\n", 0, budget)
+                if cut <= 0:
+                    # 沒有換行只能硬切：不可切在跳脫字元 "\" 與被跳脫的字元之間
+                    cut = budget
+                    backslashes = len(block[:cut]) - len(block[:cut].rstrip("\\"))
+                    if backslashes % 2:
+                        cut -= 1
+                if current:
+                    pages.append(current)
+                    current = ""
+                pages.append(block[:cut])
+                block = block[cut:]
+            if current and len(current) + 1 + len(block) > budget:
+                pages.append(current)
+                current = ""
+            current = f"{current}\n{block}" if current else block
+        if current:
+            pages.append(current)
+        return pages
+
+    def page_text(self, page):
+        footer = escape_markdown(f"\n(第 {page + 1}/{len(self.pages)} 頁)") if len(self.pages) > 1 else ""
+        return f"{self._title()}\n{self.pages[page]}{footer}"
+
+    def keyboard(self, page):
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️ 上一頁", callback_data=f"mstat_{self.report_id}_{page - 1}"))
+        if page < len(self.pages) - 1:
+            nav.append(InlineKeyboardButton("下一頁 ▶️", callback_data=f"mstat_{self.report_id}_{page + 1}"))
+        rows = [nav] if nav else []
+        rows.append([InlineKeyboardButton("📄 下載完整檔案", callback_data=f"mstat_{self.report_id}_file")])
+        return InlineKeyboardMarkup(rows)
+
+    def to_csv_bytes(self):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["username", "name", "date", "checkin", "checkout"])
+        for uname_r, info in sorted(self.stat_month.items()):
+            for day in sorted(info["days"].keys()):
+                rec = info["days"][day]
+                writer.writerow([uname_r, info["name"], f"{self.prefix}-{day}", rec["in"], rec["out"]])
+        return buf.getvalue().encode("utf-8-sig")   # 加 BOM 方便 Excel 開啟
+
+
+class MonthReportCache:
+    """以 (月份, 目標使用者, 資料版本) 為 key 的 LRU 報表快取；翻頁時直接取用已分好的頁面。"""
+
+    def __init__(self, max_reports):
+        self.max_reports = max_reports
+        self._by_key = OrderedDict()    # (prefix, target, version) -> MonthReport
+        self._by_id = {}                # report_id -> MonthReport
+
+    async def get_or_build(self, prefix, target_uname):
+        key = (prefix, target_uname, storage.attendance_version)
+        report = self._by_key.get(key)
+        if report is not None:
+            self._by_key.move_to_end(key)
+            return report
+        records = await storage.query_attendance(f"{prefix}-01", f"{prefix}-31", target_uname)
+        report = MonthReport(self._new_id(), prefix, target_uname, records)
+        self._by_key[key] = report
+        self._by_id[report.report_id] = report
+        while len(self._by_key) > self.max_reports:
+            _, evicted = self._by_key.popitem(last=False)
+            self._by_id.pop(evicted.report_id, None)
+        return report
+
+    def _new_id(self):
+        # 隨機 id：重啟後舊訊息上的按鈕只會找不到報表 (回覆已過期)，不會對應到別人的新報表
+        while True:
+            report_id = secrets.token_hex(4)
+            if report_id not in self._by_id:
+                return report_id
+
+    def get(self, report_id):
+        return self._by_id.get(report_id)
+
+
+month_reports = MonthReportCache(MONTH_REPORT_CACHE_SIZE)
+
+
+@timed(HANDLER_SECONDS, HANDLER_ERRORS, handler="monthstat")
+@tracer.traced("monthstat")
 async def _monthstat_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
     prefix = datetime.now().strftime("%Y-%m")
     target_uname = context.args[0].lower() if context.args else None
 
-    records = []
-    if os.path.exists(ATTENDANCE_CSV):
-        with open(ATTENDANCE_CSV, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row["date"].startswith(prefix):
-                    if not target_uname or row["username"] == target_uname:
-                        records.append(row)
+    with tracer.span("build_report"):
+        report = await month_reports.get_or_build(prefix, target_uname)
 
-    if not records:
+    if not report.pages:
         escaped_prefix = escape_markdown(prefix)
         msg = f"❌ {escaped_prefix} 尚無任何打卡紀錄。"
         if target_uname:
             msg = f"❌ 找不到使用者 `@{escape_markdown(target_uname)}` 在 {escaped_prefix} 的打卡紀錄。"
-        await update.message.reply_text(msg, parse_mode="MarkdownV2")
+        await outbound.reply(update.message, msg, parse_mode="MarkdownV2")
         return
 
-    stat_month = {}
-    for row in records:
-        uname_r, day = row["username"], row["date"].split("-")[2]
-        if uname_r not in stat_month: stat_month[uname_r] = {"name": row["name"], "days": {}}
-        if day not in stat_month[uname_r]["days"]: stat_month[uname_r]["days"][day] = {"in": "—", "out": "—"}
-
-        ts = row["timestamp"].split(" ")[1]
-        if row["type"] == "in": stat_month[uname_r]["days"][day]["in"] = ts
-        elif row["type"] == "out": stat_month[uname_r]["days"][day]["out"] = ts
+    with tracer.span("reply"):
+        await outbound.reply(update.message, report.page_text(0), parse_mode="MarkdownV2", reply_markup=report.keyboard(0))
 
-    escaped_prefix = escape_markdown(prefix)
-    title_target = f" for `@{escape_markdown(target_uname)}`" if target_uname else ""
-    msg_lines = [f"📅 *{escaped_prefix} 月度打卡統計*{title_target}"]
 
-    for uname_r, info in sorted(stat_month.items()):
-        # FIX: Construct the header line first, then escape the ENTIRE line.
-        # This correctly handles '─', '@', '(', and ')' characters.
-        header_line = f"\n── @{uname_r} ({info['name']}) ──"
-        msg_lines.append(escape_markdown(header_line))
+@timed(HANDLER_SECONDS, HANDLER_ERRORS, handler="monthstat_page")
+@tracer.traced("monthstat_page")
+async def handle_monthstat_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """處理月報的翻頁與下載檔案按鈕。"""
+    query = update.callback_query
+    if not users.has_role(query.from_user.id, "supervisor"):
+        await query.answer("❌ 您沒有權限執行此操作。", show_alert=True)
+        return
 
-        for day in sorted(info["days"].keys()):
-            rec = info["days"][day]
-            in_t = escape_markdown(rec["in"])
-            out_t = escape_markdown(rec["out"])
-            msg_lines.append(f"{escape_markdown(day)}日: 上班 {in_t}, 下班 {out_t}")
+    _, report_id, page = (query.data.split("_", 2) + ["", ""])[:3]
+    report = month_reports.get(report_id)
+    if report is None or not (page == "file" or page.isdigit()):
+        await query.answer("⚠️ 報表已過期，請重新執行 /monthstat。", show_alert=True)
+        return
+    await query.answer()
 
-    full_msg = "\n".join(msg_lines)
+    if page == "file":
+        await outbound.submit(query.message.chat_id, functools.partial(
+            context.bot.send_document,
+            chat_id=query.message.chat_id,
+            document=report.to_csv_bytes(),
+            filename=f"monthstat_{report.prefix}{'_' + report.target_uname if report.target_uname else ''}.csv",
+            caption=f"📄 {report.prefix} 月度打卡統計"
+        ))
+        return
 
-    if len(full_msg) > 4096:
-        await update.message.reply_text("資料過多，無法完整顯示。")
-    else:
-        await update.message.reply_text(full_msg, parse_mode="MarkdownV2")
+    page = int(page)
+    if 0 <= page < len(report.pages):
+        await outbound.edit(query, report.page_text(page), parse_mode="MarkdownV2", reply_markup=report.keyboard(page))
 
 
 async def _msg_to_employee_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) < 2:
-        await update.message.reply_text("❌ 用法：/msg [username] [訊息文字]")
+        await outbound.reply(update.message, "❌ 用法：/msg [username] [訊息文字]")
         return
 
     target_uname = context.args[0].lower()
-    if target_uname not in users or not users[target_uname].get("user_id"):
-        await update.message.reply_text(f"❌ 找不到員工 @{escape_markdown(target_uname)} 或該員工尚未啟用 Bot。", parse_mode="MarkdownV2")
+    if target_uname not in users or not users[target_uname].user_id:
+        await outbound.reply(update.message, f"❌ 找不到員工 @{escape_markdown(target_uname)} 或該員工尚未啟用 Bot。", parse_mode="MarkdownV2")
         return
 
     message_text = " ".join(context.args[1:])
-    sender_uname = update.effective_user.username.lower()
-    sender_display = users[sender_uname].get("name", f"@{sender_uname}")
+    sender = users.by_user_id(update.effective_user.id)
+    sender_display = sender.name or f"@{sender.username}"
 
     # FIX: Escape all dynamic text to prevent errors
     escaped_sender = escape_markdown(sender_display)
@@ -1105,22 +3972,225 @@ async def _msg_to_employee_impl(update: Update, context: ContextTypes.DEFAULT_TY
     full_message = f"📨 來自 *{escaped_sender}* 的訊息:\n\n{escaped_message}"
 
     try:
-        await context.bot.send_message(chat_id=users[target_uname]["user_id"], text=full_message, parse_mode="MarkdownV2")
-        await update.message.reply_text(f"✅ 已成功私訊 @{escape_markdown(target_uname)}。", parse_mode="MarkdownV2")
+        await outbound.send_message(context.bot, users[target_uname].user_id, full_message, parse_mode="MarkdownV2")
+        await outbound.reply(update.message, f"✅ 已成功私訊 @{escape_markdown(target_uname)}。", parse_mode="MarkdownV2")
     except Exception as e:
-        await update.message.reply_text(f"❌ 私訊失敗：{e}")
+        await outbound.reply(update.message, f"❌ 私訊失敗：{e}")
+
+
+_profile_running = False
+
+async def _profile_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [秒數]：在背景擷取 event loop 執行緒的 cProfile，結束後以檔案回傳最耗時的呼叫路徑。"""
+    global _profile_running
+    try:
+        seconds = int(context.args[0]) if context.args else 30
+    except ValueError:
+        await outbound.reply(update.message, f"❌ 用法：/profile [秒數，最多 {PROFILE_MAX_SECONDS}]")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if _profile_running:
+        await outbound.reply(update.message, "⚠️ 已有效能擷取正在進行中。")
+        return
+    _profile_running = True
+    chat_id = update.effective_chat.id
+    await outbound.reply(update.message, f"⏱️ 開始擷取 {seconds} 秒的效能資料，完成後會傳送檔案。")
+
+    async def capture():
+        # 在背景 task 中等待，不佔住 handler (其他更新照常處理並被記錄)
+        global _profile_running
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            _profile_running = False
+        buf = io.StringIO()
+        buf.write(f"EZClock profile: {seconds}s, event loop thread, captured at {datetime.now().isoformat(timespec='seconds')}\n\n")
+        stats = pstats.Stats(profiler, stream=buf)
+        stats.sort_stats("cumulative").print_stats(40)
+        stats.sort_stats("tottime").print_stats(40)
+        try:
+            await outbound.submit(chat_id, functools.partial(
+                context.bot.send_document,
+                chat_id=chat_id, document=buf.getvalue().encode("utf-8"),
+                filename=f"profile_{datetime.now():%Y%m%d_%H%M%S}.txt",
+                caption=f"📈 {seconds} 秒效能擷取結果 (依累計與自身耗時排序)"
+            ))
+        except Exception as e:
+            print(f"[Profile Error] Failed to send profile result: {e}")
 
+    spawn_background(capture())
+
+async def _traces_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/traces：以 JSON 檔案回傳 ring buffer 中最近抽樣到的 trace。"""
+    traces = tracer.recent()
+    if not traces:
+        await outbound.reply(update.message, f"❌ 目前沒有任何 trace (抽樣比例 {TRACE_SAMPLE_RATE:g})。")
+        return
+    await outbound.submit(update.effective_chat.id, functools.partial(
+        context.bot.send_document,
+        chat_id=update.effective_chat.id,
+        document=json.dumps(traces, ensure_ascii=False, indent=1).encode("utf-8"),
+        filename=f"traces_{datetime.now():%Y%m%d_%H%M%S}.json",
+        caption=f"🧭 最近 {len(traces)} 筆 trace"
+    ))
 
 # ==== Bot 啟動主函式 ====
+class PerUserOrderedApplication(Application):
+    """不同使用者的更新並行處理，同一使用者 (或沒有使用者時同一聊天室) 的更新嚴格依序處理。
+
+    context.user_data 中的對話狀態 (await_leave_reason、denying_leave_request_id...) 因此不會被
+    同一人的下一則訊息搶先讀寫。每個 key 只保留最後一個更新的完成 Future，前一個做完才輪到下一個；
+    排隊期間不佔用並行名額。
+
+    PTB 20.0 的取件迴圈對每個更新都立即建立 task，不會回壓 update_queue；這裡改成先取得名額
+    (最多 DISPATCH_MAX_PENDING 個) 才取出更新，超過的更新留在 update_queue，佇列深度指標因此反映真正的積壓。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._dispatch_tails = {}   # key -> 該 key 最後一個更新的完成 Future
+        self._dispatch_slots = asyncio.Semaphore(DISPATCH_CONCURRENCY)
+        self._dispatch_pending = asyncio.Semaphore(DISPATCH_MAX_PENDING)
+
+    async def _update_fetcher(self):
+        while True:
+            await self._dispatch_pending.acquire()
+            update = await self.update_queue.get()
+            if update is _STOP_SIGNAL:
+                self._dispatch_pending.release()
+                while not self.update_queue.empty():    # 與 PTB 相同：停止後不再處理剩下的更新
+                    self.update_queue.get_nowait()
+                    self.update_queue.task_done()
+                self.update_queue.task_done()
+                return
+            self.create_task(self._dispatch_fetched(update), update=update)
+
+    async def _dispatch_fetched(self, update):
+        try:
+            await self.process_update(update)
+        finally:
+            self.update_queue.task_done()
+            self._dispatch_pending.release()
+
+    @staticmethod
+    def _dispatch_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return ("user", update.effective_user.id)
+        if update.effective_chat:
+            return ("chat", update.effective_chat.id)
+        return None
+
+    async def process_update(self, update):
+        key = self._dispatch_key(update)
+        previous = self._dispatch_tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._dispatch_tails[key] = done
+        queued_at = time_mod.perf_counter()
+        DISPATCH_WAITING.inc()
+        waiting = True
+        try:
+            if previous is not None:
+                await asyncio.wait({previous})     # 不用 await previous：取消時不能連帶取消前一個
+            async with self._dispatch_slots:
+                DISPATCH_WAITING.dec()
+                waiting = False
+                DISPATCH_WAIT_SECONDS.observe(time_mod.perf_counter() - queued_at)
+                DISPATCH_ACTIVE.inc()
+                try:
+                    return await super().process_update(update)
+                finally:
+                    DISPATCH_ACTIVE.dec()
+        finally:
+            if waiting:
+                DISPATCH_WAITING.dec()
+            if previous is not None and not previous.done():
+                # 排隊中被取消：等前一個做完才放行下一個，順序保證不因取消而中斷
+                previous.add_done_callback(lambda _: self._finish_dispatch(key, done))
+            else:
+                self._finish_dispatch(key, done)
+
+    def _finish_dispatch(self, key, done):
+        done.set_result(None)
+        if key is not None and self._dispatch_tails.get(key) is done:
+            del self._dispatch_tails[key]
+
+async def on_startup(application: Application) -> None:
+    """Application 初始化後執行：記錄 event loop 供 Flask 執行緒使用。"""
+    global bot_loop
+    bot_loop = asyncio.get_running_loop()
+    storage.start()
+    outbound.start()
+    gps_store.start()
+    spawn_background(requeue_pending_addresses())
+
+async def on_shutdown(application: Application) -> None:
+    """Application 關閉時執行：寫入快照、寫完佇列中的 CSV 資料並保存快取。"""
+    await gps_store.close()
+    await outbound.close()
+    await write_state_snapshot()
+    await storage.close()
+    state.close()
+    geocode_cache.save()
+
+async def run_webhook(application: Application) -> None:
+    """Webhook 模式：向 Telegram 登記 webhook，更新由 Flask 的 /telegram/webhook 送入；登記失敗時退回 polling。"""
+    await application.initialize()
+    await on_startup(application)
+    try:
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL}{TELEGRAM_WEBHOOK_PATH}",
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        print("[Info] Webhook registered, receiving updates via Flask.")
+    except Exception as e:
+        print(f"[Warning] Failed to set webhook: {e}. Falling back to polling.")
+        await application.updater.start_polling()
+    await application.start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass    # Windows 不支援，改由 KeyboardInterrupt 結束
+    try:
+        await stop_event.wait()
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+
 def main() -> None:
+    global telegram_app
     # 初始化
-    load_users()
-    ensure_attendance_csv()
-    ensure_leave_csv()
-    restore_today_status()
+    storage.open()
+    state.open()
+    if not restore_from_snapshot():
+        load_users()
+        restore_today_status()
+    geocode_cache.load()
+    holiday_calendar.load(HOLIDAY_SOURCE_FILE)
+    site_registry.load()
 
     # 建立 Application
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = Application.builder().token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown) \
+        .application_class(PerUserOrderedApplication)
+    # 自訂 request 時需自行指定連線池大小 (預設只有 1)；getUpdates 另用一條連線
+    builder = builder.request(InstrumentedRequest(connection_pool_size=256)) \
+        .get_updates_request(InstrumentedRequest())
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    application = builder.build()
 
     # 指令處理
     application.add_handler(CommandHandler("start", start))
@@ -1128,10 +4198,13 @@ def main() -> None:
     application.add_handler(CommandHandler("todaystat", lambda u, c: supervisor_command(u, c, _todaystat_impl)))
     application.add_handler(CommandHandler("monthstat", lambda u, c: supervisor_command(u, c, _monthstat_impl)))
     application.add_handler(CommandHandler("msg", lambda u, c: supervisor_command(u, c, _msg_to_employee_impl)))
+    application.add_handler(CommandHandler("profile", lambda u, c: supervisor_command(u, c, _profile_impl)))
+    application.add_handler(CommandHandler("traces", lambda u, c: supervisor_command(u, c, _traces_impl)))
 
     # 按鈕與訊息處理 (順序很重要)
     # 1. 處理 Inline Keyboard 回調 (最高優先級)
     application.add_handler(CallbackQueryHandler(handle_approval, pattern="^(approve_|deny_).+"))
+    application.add_handler(CallbackQueryHandler(handle_monthstat_page, pattern="^mstat_"))
 
     # 2. 處理固定回覆按鈕
     application.add_handler(MessageHandler(filters.Regex(r"^📝 申請休假$"), start_leave_request))
@@ -1185,12 +4258,55 @@ def main() -> None:
         name="overnight_checkout_check"
     )
 
+    # 每日上班前 WARMUP_LEAD_MINUTES 分鐘預熱快取與連線
+    warmup_at = datetime.combine(datetime.now().date(), time(hour=h, minute=m)) - timedelta(minutes=WARMUP_LEAD_MINUTES)
+    application.job_queue.run_daily(
+        pre_rush_warmup,
+        time=time(hour=warmup_at.hour, minute=warmup_at.minute, tzinfo=tz),
+        name="pre_rush_warmup"
+    )
+
+    # 每日 03:00 背景更新假日行事曆；若今年尚未載入則啟動後立即下載
+    application.job_queue.run_daily(
+        refresh_holiday_calendar,
+        time=time(hour=3, minute=0, tzinfo=tz),
+        name="holiday_calendar_refresh"
+    )
+    if not holiday_calendar.has_year(datetime.now().year):
+        application.job_queue.run_once(refresh_holiday_calendar, when=1, name="holiday_calendar_initial")
+
+    # 每 5 分鐘保存地理編碼快取與儲存層索引
+    application.job_queue.run_repeating(save_geocode_cache_job, interval=300, first=300, name="geocode_cache_save")
+    application.job_queue.run_repeating(storage_checkpoint_job, interval=300, first=300, name="storage_checkpoint")
+    application.job_queue.run_repeating(state_snapshot_job, interval=300, first=60, name="state_snapshot")
+    application.job_queue.run_repeating(refresh_metrics_job, interval=METRICS_REFRESH_SECONDS, first=1,
+                                        name="metrics_refresh")
+
+    # 啟動 Flask 在背景執行 (GPS 頁面、/submit 與 webhook)
+    threading.Thread(target=run_flask, daemon=True).start()
+
     # 啟動 Bot
-    print("[Info] Bot is running...")
-    application.run_polling()
+    telegram_app = application
+    print(f"[Info] Bot is running ({UPDATE_MODE})...")
+    if UPDATE_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
-    if not all([BOT_TOKEN, Maps_API_KEY, WEBHOOK_URL, GROUP_CHAT_ID]):
+    import sys
+    # 儲存層資料搬移：python main.py --import-csv (CSV -> 目前引擎) / --export-csv (目前引擎 -> CSV)
+    if "--import-csv" in sys.argv or "--export-csv" in sys.argv:
+        storage.open()
+        if "--import-csv" in sys.argv:
+            storage.import_csv()
+        else:
+            storage.export_csv()
+        storage.close_sync()
+    elif "--gps-worker" in sys.argv:
+        # 額外的 GPS worker 程序：python main.py --gps-worker (以 FLASK_PORT 指定連接埠)
+        run_gps_worker()
+    elif not all([BOT_TOKEN, Maps_API_KEY, WEBHOOK_URL, GROUP_CHAT_ID]):
         print("[Fatal] One or more required environment variables (BOT_TOKEN, MAPS_API_KEY, WEBHOOK_URL, GROUP_CHAT_ID) are missing.")
     else:
         main()
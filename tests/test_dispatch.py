@@ -0,0 +1,141 @@
+"""PerUserOrderedApplication 的分派測試：同一使用者依序、不同使用者並行、取件數有上限。
+
+執行：python -m unittest discover -s tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+import warnings
+from datetime import datetime
+from unittest import mock
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN")
+os.environ.setdefault("GROUP_CHAT_ID", "-100")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+from telegram.ext import Application, CallbackQueryHandler
+
+import main
+
+
+def make_update(update_id, user_id):
+    user = User(user_id, f"user{user_id}", False)
+    message = Message(update_id, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user, text="hi")
+    return Update(update_id, message=message)
+
+
+class PerUserOrderedApplicationTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.app = Application.builder().token(os.environ["BOT_TOKEN"]) \
+            .application_class(main.PerUserOrderedApplication).build()
+        self.events = []        # ("start" | "end", update_id)
+        self.delays = {}        # update_id -> 模擬的處理秒數
+        self.release = None     # 設定時，處理中的更新會等到它被 set
+
+        async def fake_process_update(app, update):
+            self.events.append(("start", update.update_id))
+            if self.release is not None:
+                await self.release.wait()
+            await asyncio.sleep(self.delays.get(update.update_id, 0))
+            self.events.append(("end", update.update_id))
+
+        patcher = mock.patch.object(Application, "process_update", fake_process_update)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def index(self, kind, update_id):
+        return self.events.index((kind, update_id))
+
+    async def test_same_user_updates_run_in_order(self):
+        # 先到的更新處理較久，仍須先完成
+        self.delays = {1: 0.03, 2: 0.02, 3: 0.01}
+        await asyncio.gather(*(self.app.process_update(make_update(i, 7)) for i in (1, 2, 3)))
+        self.assertEqual(self.events, [("start", 1), ("end", 1), ("start", 2), ("end", 2), ("start", 3), ("end", 3)])
+        self.assertEqual(self.app._dispatch_tails, {})
+
+    async def test_different_users_run_concurrently(self):
+        self.delays = {1: 0.05, 2: 0.05, 3: 0.05}
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.gather(*(self.app.process_update(make_update(i, 100 + i)) for i in (1, 2, 3)))
+        self.assertLess(loop.time() - started, 0.12)
+        self.assertEqual({kind for kind, _ in self.events[:3]}, {"start"})
+
+    async def test_cancelled_queued_update_keeps_order(self):
+        self.delays = {1: 0.05}
+        first = asyncio.create_task(self.app.process_update(make_update(1, 7)))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(self.app.process_update(make_update(2, 7)))
+        await asyncio.sleep(0)
+        last = asyncio.create_task(self.app.process_update(make_update(3, 7)))
+        await asyncio.sleep(0.01)
+        queued.cancel()
+        await asyncio.gather(first, queued, last, return_exceptions=True)
+        self.assertNotIn(("start", 2), self.events)
+        self.assertLess(self.index("end", 1), self.index("start", 3))
+
+    async def test_fetcher_leaves_excess_updates_in_queue(self):
+        self.app._dispatch_pending = asyncio.Semaphore(2)
+        self.release = asyncio.Event()
+        for i in range(5):
+            self.app.update_queue.put_nowait(make_update(i, 200 + i))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")     # Application 未 start，create_task 會警告不會自動等待
+            fetcher = asyncio.create_task(self.app._update_fetcher())
+            await asyncio.sleep(0.01)
+            self.assertEqual(len(self.events), 2)
+            self.assertEqual(self.app.update_queue.qsize(), 3)
+
+            self.release.set()
+            await self.app.update_queue.put(main._STOP_SIGNAL)
+            await asyncio.wait_for(self.app.update_queue.join(), timeout=1)
+            await asyncio.wait_for(fetcher, timeout=1)
+        self.assertEqual(sorted(i for kind, i in self.events if kind == "end"), [0, 1, 2, 3, 4])
+
+
+class LeaveApprovalRaceTest(unittest.IsolatedAsyncioTestCase):
+    """兩位主管同時按下同一張假單：只有一人能處理，員工只收到一則通知。"""
+
+    async def asyncSetUp(self):
+        self.app = Application.builder().token(os.environ["BOT_TOKEN"]) \
+            .application_class(main.PerUserOrderedApplication).build()
+        self.app.add_handler(CallbackQueryHandler(main.handle_approval, pattern="^(approve_|deny_).+"))
+        self.app._initialized = True        # 不呼叫 initialize()：測試中不連線 Bot API
+        self.edits = []
+
+        async def slow_send(*args, **kwargs):
+            await asyncio.sleep(0.01)       # 讓另一個回呼有機會在此期間執行
+
+        async def record_edit(query, text, **kwargs):
+            self.edits.append((query.from_user.id, text))
+
+        for patcher in (
+            mock.patch.object(main.outbound, "send_message", mock.AsyncMock(side_effect=slow_send)),
+            mock.patch.object(main.storage, "update_leave", mock.AsyncMock()),
+            mock.patch.object(CallbackQuery, "answer", mock.AsyncMock()),
+            mock.patch.object(CallbackQuery, "edit_message_text", record_edit),
+            mock.patch.dict(main.pending_leave, {"req1": {
+                "employee_user_id": 9, "employee_name": "Emp", "reason": "rest", "group_message_id": 1}}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_callback(self, update_id, user_id, data):
+        user = User(user_id, f"boss{user_id}", False, username=f"boss{user_id}")
+        message = Message(update_id, datetime.now(), Chat(-100, Chat.SUPERGROUP), text="leave")
+        return Update(update_id, callback_query=CallbackQuery(str(update_id), user, "ci", message=message, data=data))
+
+    async def test_concurrent_approvals_handled_once(self):
+        await asyncio.gather(self.app.process_update(self.make_callback(1, 11, "approve_req1")),
+                             self.app.process_update(self.make_callback(2, 12, "approve_req1")))
+        self.assertEqual(main.outbound.send_message.await_count, 1)
+        self.assertEqual(main.storage.update_leave.await_count, 1)
+        self.assertNotIn("req1", main.pending_leave)
+        self.assertEqual(sorted(text.startswith("⚠️") for _, text in self.edits), [False, True])
+
+
+if __name__ == "__main__":
+    unittest.main()